@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmarks for cac.py, run with:
+
+    python -m benchmarks [--rows=10,1000,100000] [--phases=parse,write_csv]
+                         [--accounts=4] [--output=bench.json] [--compare=old.json]
+
+Synthetic wallet pages, Bitstamp/Coinbase Pro minute files and account
+configs are generated under --data (a temporary folder by default).  Each
+phase is timed in its own process and results are saved as JSON so two
+versions can be compared.
+"""
@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+
+import json
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+from os import makedirs
+from os.path import abspath, dirname, exists, join
+from platform import platform, python_version
+from subprocess import run, PIPE, DEVNULL
+from sys import argv
+from tempfile import mkdtemp
+from time import strftime
+
+from .phases import PHASES, BITSTAMP_FILE, COINBASEPRO_FILE, run_phase
+from .synthetic import transaction_html, bitstamp_csv, coinbasepro_csv, account_configs
+
+PACKAGE_DIR = dirname(dirname(abspath(__file__)))
+
+
+def process_command_arguments():
+    options = {
+        "rows": "10,1000,100000",
+        "phases": ",".join(PHASES),
+        "accounts": "4",
+        "output": "bench.json",
+    }
+    for arg in argv[1:]:
+        if arg[0:2] != "--" or '=' not in arg:
+            assert False, f"Argument '{arg}' not valid!"
+        key, value = arg[2:].split('=', 1)
+        options[key] = value
+    return options
+
+
+def git_version():
+    try:
+        result = run(["git", "describe", "--always", "--dirty"], cwd=PACKAGE_DIR,
+                     stdout=PIPE, stderr=DEVNULL, universal_newlines=True)
+        return result.stdout.strip() or "unknown"
+    except OSError:
+        return "unknown"
+
+
+def generate_data(data_dir, rows, accounts):
+    directory = join(data_dir, str(rows))
+    if exists(join(directory, "page.html")):
+        return directory
+    print(f"Generating {rows} row data set...")
+    makedirs(directory, exist_ok=True)
+    with open(join(directory, "page.html"), "w") as f:
+        f.write(transaction_html(rows))
+    bitstamp_csv(join(directory, BITSTAMP_FILE), rows)
+    coinbasepro_csv(join(directory, COINBASEPRO_FILE), rows)
+    account_configs(join(directory, "accounts"), accounts, rows)
+    return directory
+
+
+def measure(phase, rows, directory):
+    # A fresh process per measurement keeps peak RSS per phase
+    with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as pool:
+        return pool.submit(run_phase, phase, rows, directory, PACKAGE_DIR).result()
+
+
+def compare(results, file_name):
+    with open(file_name, "r") as f:
+        baseline = json.load(f)
+    before = {(r["phase"], r["size"]): r for r in baseline["results"]}
+    print("")
+    print(f"Compared with {baseline['version']} ({baseline['timestamp']}):")
+    for result in results:
+        old = before.get((result["phase"], result["size"]))
+        if old is None or old["seconds"] == 0:
+            continue
+        ratio = result["seconds"] / old["seconds"]
+        print(f"  {result['phase']:30} {result['size']:>9}  {ratio:6.2f}x time")
+
+
+def main():
+    options = process_command_arguments()
+    data_dir = options.get("data") or mkdtemp(prefix="cac-bench-")
+    sizes = [int(rows) for rows in options["rows"].split(',')]
+    phases = options["phases"].split(',')
+    for phase in phases:
+        assert phase in PHASES, f"Unknown phase '{phase}'"
+
+    results = []
+    print(f"{'phase':30} {'rows':>9} {'seconds':>9} {'rows/s':>12} {'peak RSS KB':>12}")
+    for rows in sizes:
+        directory = generate_data(data_dir, rows, int(options["accounts"]))
+        for phase in phases:
+            result = measure(phase, rows, directory)
+            if result is None:
+                print(f"{phase:30} {rows:>9}   skipped")
+                continue
+            result["size"] = rows
+            results.append(result)
+            print(f"{phase:30} {result['rows']:>9} {result['seconds']:9.3f} "
+                  f"{result['rows_per_second'] or 0:12.0f} {result['peak_rss_kb'] or 0:12}")
+
+    report = {
+        "version": options.get("label", git_version()),
+        "timestamp": strftime("%Y-%m-%d %H:%M:%S"),
+        "python": python_version(),
+        "platform": platform(),
+        "results": results,
+    }
+    with open(options["output"], "w") as f:
+        json.dump(report, f, indent=2)
+    print("Saved", options["output"])
+
+    if "compare" in options:
+        compare(results, options["compare"])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins for remote services, so cac.py code paths that talk to them
+can be timed and checked offline.
+"""
+
+from datetime import datetime, timezone
+from random import Random
+from threading import Lock
+
+
+class FakeWorksheet:
+    # In-memory gspread Worksheet with the calls cac.py makes.  Values are
+    # kept as strings like the Sheets API returns them; requests and cells
+    # written are counted.
+    def __init__(self):
+        self.rows = []
+        self.requests = 0
+        self.cells_written = 0
+
+    def _row(self, row):
+        while len(self.rows) < row:
+            self.rows.append([])
+        return self.rows[row - 1]
+
+    def _set(self, row, col, value):
+        values = self._row(row)
+        while len(values) < col:
+            values.append("")
+        values[col - 1] = str(value)
+        self.cells_written += 1
+
+    def update_cells(self, cell_list, value_input_option="RAW"):
+        self.requests += 1
+        for cell in cell_list:
+            self._set(cell.row, cell.col, cell.value)
+
+    def update_acell(self, label, value):
+        from gspread.utils import a1_to_rowcol
+        self.requests += 1
+        row, col = a1_to_rowcol(label)
+        self._set(row, col, value)
+
+    def insert_rows(self, values, row=1, value_input_option="RAW", inherit_from_before=False):
+        self.requests += 1
+        self._row(row - 1)
+        self.rows[row - 1:row - 1] = [[str(value) for value in new] for new in values]
+        self.cells_written += sum(len(new) for new in values)
+
+    def col_values(self, col):
+        self.requests += 1
+        values = [row[col - 1] if len(row) >= col else "" for row in self.rows]
+        while len(values) > 0 and values[-1] == "":
+            values.pop()
+        return values
+
+    def get_all_values(self):
+        return [list(row) for row in self.rows]
+
+
+class FakePublicClient:
+    # coinbasepro.PublicClient with the call cac.py makes, serving made up
+    # minute candles for every epoch in [start, end) except `missing` ones
+    # (an outage, or minutes without trades).  Like the API, a request
+    # returns at most 300 candles, newest first, with "time" as a naive UTC
+    # datetime.  fail_rate raises on that share of requests; requests are
+    # counted.
+    def __init__(self, start, end, missing=(), fail_rate=0.0, seed=0):
+        self.start = start
+        self.end = end
+        self.missing = set(missing)
+        self.fail_rate = fail_rate
+        self.seed = seed
+        self.random = Random(seed)
+        self.requests = 0
+        self.lock = Lock()
+
+    def candle(self, epoch):
+        rnd = Random(self.seed * 1000003 + epoch)
+        open_ = round(29000.0 + rnd.gauss(0, 500), 2)
+        close = round(open_ + rnd.gauss(0, 25), 2)
+        return {"time": datetime.utcfromtimestamp(epoch), "open": open_,
+                "high": round(max(open_, close) + rnd.random() * 10, 2),
+                "low": round(min(open_, close) - rnd.random() * 10, 2),
+                "close": close, "volume": round(rnd.random() * 5, 8)}
+
+    def has(self, epoch):
+        return self.start <= epoch < self.end and epoch % 60 == 0 and epoch not in self.missing
+
+    def get_product_historic_rates(self, product_id, start=None, end=None, granularity=60):
+        with self.lock:
+            self.requests += 1
+            if self.random.random() < self.fail_rate:
+                raise ConnectionError("Coinbase Pro request failed")
+        t0 = int(datetime.fromisoformat(start).replace(tzinfo=timezone.utc).timestamp())
+        t1 = int(datetime.fromisoformat(end).replace(tzinfo=timezone.utc).timestamp())
+        t0 += -t0 % 60
+        epochs = [epoch for epoch in range(t0, t1 + 1, 60) if self.has(epoch)]
+        return [self.candle(epoch) for epoch in reversed(epochs[:300])]
@@ -0,0 +1,419 @@
+# -*- coding: utf-8 -*-
+"""
+Benchmark phases.  Each phase has a setup step (not timed) and a timed step
+that returns the number of rows it handled.  run_phase() is called in a fresh
+process per measurement so the peak RSS belongs to that phase alone.
+"""
+
+import sys
+from contextlib import redirect_stdout
+from subprocess import run, DEVNULL
+from glob import glob
+from os import chdir, devnull, makedirs, unlink
+from os.path import exists
+from time import perf_counter, process_time, time
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+    resourceDisabledInternal = False
+except ImportError:
+    resourceDisabledInternal = True
+
+BITSTAMP_FILE = "Bitstamp_BTCUSD_2021_minute.csv"
+COINBASEPRO_FILE = "coinbasepro.csv"
+
+
+def peak_rss_kb():
+    if resourceDisabledInternal:
+        return None
+    peak = getrusage(RUSAGE_SELF).ru_maxrss
+    if sys.platform == "darwin":
+        peak //= 1024  # bytes on macOS, kilobytes on Linux
+    return peak
+
+
+def remove(file_name):
+    if exists(file_name):
+        unlink(file_name)
+
+
+def account_config(cac, **options):
+    config = {}
+    cac.set_defaults(config)
+    config.update(run_mode="Automatic", interactive=False, configModified=False,
+                  silentMode=True, useLedger=False, saveCSV=False, csvFile="bench.csv",
+                  ledgerFile="bench-ledger.db")
+    config.update(options)
+    return config
+
+
+def read_page(cac, rows):
+    with open("page.html", "r") as f:
+        return f.read()
+
+
+def synthetic_transactions(cac, rows):
+    # process_transactions() rows, newest first
+    transactions = []
+    for x in range(rows, 0, -1):
+        transactions.append([1609459200 + 60 * x, x, "2021-01-01 00:00 EST-0500", "Miner",
+                             1000 + x % 50, "+0.00012345", "BTC", "$3.5801", "$29000.0"])
+    return transactions
+
+
+def setup_price_cold(file_name):
+    def setup(cac, rows):
+        remove(file_name.replace(".csv", ".bin"))
+        remove(file_name.replace(".csv", ".idx"))
+        return file_name
+    return setup
+
+
+def setup_price_warm(file_name):
+    def setup(cac, rows):
+        if file_name == COINBASEPRO_FILE:
+            cac.load_coinbasepro_usd(file_name, cac.PriceStore())
+        else:
+            cac.PriceStore().load_csv(file_name)
+        return file_name
+    return setup
+
+
+def work_load_bitcoin_usd(cac, file_name):
+    store = cac.PriceStore()
+    cac.load_bitcoin_usd(file_name, store)
+    return len(store)
+
+
+def work_load_coinbasepro_usd(cac, file_name):
+    # Index the file and read every day of it
+    store = cac.PriceStore()
+    last = cac.load_coinbasepro_usd(file_name, store)
+    store.require([(0, last)])
+    return len(store)
+
+
+def work_resume_coinbasepro_usd(cac, file_name):
+    # What each run pays before pricing: the index check and tail seek
+    store = cac.PriceStore()
+    cac.load_coinbasepro_usd(file_name, store)
+    return len(store.sources[0].days)
+
+
+def work_price_gaps(cac, file_name):
+    # -gaps over the whole file: read every day and find the missing minutes
+    store = cac.PriceStore()
+    cac.load_coinbasepro_usd(file_name, store)
+    cac.price_gaps(store)
+    return len(store)
+
+
+def fake_coinbasepro_csv(cac, client, file_name, start, end):
+    # file_name holding the fake client's candles in [start, end)
+    with open(file_name, "w") as f:
+        for epoch in range(start, end, 60):
+            if client.has(epoch):
+                timestamp = cac.datetime.utcfromtimestamp(epoch).isoformat(" ")
+                f.write(cac.coinbasepro_line(epoch, timestamp, client.candle(epoch)))
+
+
+def setup_update_coinbasepro_usd(cac, rows):
+    # File ending three days ago, Coinbase Pro down for the last day: the
+    # update must fill the two days in between and leave a checkpoint that
+    # doesn't send the next run back over them
+    from .fakes import FakePublicClient
+    makedirs("update", exist_ok=True)
+    chdir("update")
+    for file_name in glob("coinbasepro.*"):
+        unlink(file_name)
+    now = int(time()) // 60 * 60
+    end = now - 3 * 86400
+    client = FakePublicClient(end - 60 * rows, now - 86400)
+    fake_coinbasepro_csv(cac, client, COINBASEPRO_FILE, client.start, end)
+    return client
+
+
+def work_update_coinbasepro_usd(cac, client):
+    store = cac.PriceStore()
+    cac.update_coinbasepro_usd(COINBASEPRO_FILE, store, client, rate=1000.0, burst=1000)
+    records = len(store)
+    assert cac.price_gaps(store) == [], "gaps after update_coinbasepro_usd"
+    assert store.last_epoch() == client.end - 60, "update_coinbasepro_usd stopped early"
+
+    # The next run only asks for the windows since the outage started
+    client.requests = 0
+    cac.update_coinbasepro_usd(COINBASEPRO_FILE, cac.PriceStore(), client, rate=1000.0, burst=1000)
+    assert client.requests <= 2, f"resumed run made {client.requests} requests"
+    return records
+
+
+def setup_repair_price_gaps(cac, rows):
+    # One account and a file with a hole every 1000 minutes, repaired from
+    # the fake client with --allGaps=True
+    if cac.cbpDisabledInternal:
+        return None
+    from .fakes import FakePublicClient
+    from .synthetic import account_configs
+    account_configs("repair", 1, 10)
+    chdir("repair")
+    for file_name in glob("coinbasepro.*"):
+        unlink(file_name)
+    start = 1609459200
+    end = start + 60 * rows
+    holes = set(start + 60 * x for x in range(500, rows, 1000) for x in range(x, x + 30))
+    client = FakePublicClient(start, end)
+    fake_coinbasepro_csv(cac, client, COINBASEPRO_FILE, start, end)
+    with open(COINBASEPRO_FILE, "r") as f:
+        lines = [line for line in f if int(line.split(",")[0]) not in holes]
+    with open(COINBASEPRO_FILE, "w") as f:
+        f.writelines(lines)
+    return client
+
+
+def work_repair_price_gaps(cac, client):
+    assert cac.repair_price_gaps({"allGaps": True}, client, rate=1000.0, burst=1000) == 0
+    store = cac.PriceStore()
+    cac.load_coinbasepro_usd(COINBASEPRO_FILE, store)
+    assert cac.price_gaps(store) == [], "gaps after repair_price_gaps"
+    return len(store)
+
+
+def setup_price_windows(method):
+    def setup(cac, rows):
+        cac.bitcoin = cac.PriceStore()
+        cac.bitcoin.load_csv(BITSTAMP_FILE).aggregates()
+        config = account_config(cac, fmvMethod=method, timezone="UTC")
+        epochs = list(cac.bitcoin.segments[0].epochs[::max(1, rows // 1000)])
+        return config, epochs
+    return setup
+
+
+def work_price_windows(cac, state):
+    config, epochs = state
+    for epoch in epochs:
+        cac.transaction_fmv(config, epoch)
+    return len(epochs)
+
+
+def setup_parse(parser):
+    def setup(cac, rows):
+        return read_page(cac, rows), parser
+    return setup
+
+
+def work_parse(cac, state):
+    html, parser = state
+    return sum(1 for transaction in cac.parse_transactions(html, parser))
+
+
+def setup_process(ledger):
+    def setup(cac, rows):
+        cac.prices["USD"] = cac.PriceStore()
+        cac.load_bitcoin_usd(BITSTAMP_FILE, cac.prices["USD"])
+        config = account_config(cac, useLedger=ledger)
+        html = read_page(cac, rows)
+        if ledger:
+            # Time the incremental run over an up to date ledger
+            remove(config["ledgerFile"])
+            cac.process_transactions(config, html)
+        return config, html, rows
+    return setup
+
+
+def work_process(cac, state):
+    config, html, rows = state
+    cac.process_transactions(config, html)
+    return rows
+
+
+def setup_gains(method):
+    def setup(cac, rows):
+        config, html, rows = setup_process(True)(cac, rows)
+        config["lotMethod"] = method
+        return config, cac.sqlite_connect(config["ledgerFile"]), rows
+    return setup
+
+
+def work_gains(cac, state):
+    config, ledger, rows = state
+    cac.write_gains(config, ledger)
+    return rows
+
+
+def setup_write_csv(cac, rows):
+    cac.bitcoin_loaded = True
+    return account_config(cac), synthetic_transactions(cac, rows)
+
+
+def work_write_csv(cac, state):
+    config, transactions = state
+    cac.write_csv(config, transactions)
+    return len(transactions)
+
+
+def setup_export(export_format):
+    def setup(cac, rows):
+        config, transactions = setup_write_csv(cac, rows)
+        config["exportFormat"] = export_format
+        return config, transactions
+    return setup
+
+
+def work_export(cac, state):
+    config, transactions = state
+    exports = cac.open_exports(config)
+    for transaction in transactions:
+        for export in exports:
+            export.write(transaction)
+    for export in exports:
+        export.close()
+    return len(transactions)
+
+
+def setup_sheet_cells(cac, rows):
+    if cac.gspredDisabledInternal:
+        return None
+    return setup_write_csv(cac, rows)
+
+
+def work_sheet_cells(cac, state):
+    config, transactions = state
+    cac.build_sheet_cells(config, transactions)
+    return len(transactions)
+
+
+def setup_sheet_sync(mode):
+    # Sheet already holds all but the newest 1% of the transactions
+    def setup(cac, rows):
+        if cac.gspredDisabledInternal:
+            return None
+        from .fakes import FakeWorksheet
+        cac.bitcoin_loaded = True
+        config = account_config(cac, googleSheetSync=mode, googleSheetRate=1000.0)
+        transactions = synthetic_transactions(cac, rows)
+        wksheet = FakeWorksheet()
+        cac.sync_google_sheet(config, transactions[rows // 100:], wksheet)
+        return config, transactions, wksheet
+    return setup
+
+
+def work_sheet_sync(cac, state):
+    config, transactions, wksheet = state
+    cac.sync_google_sheet(config, transactions, wksheet)
+    return len(transactions)
+
+
+def setup_accounts(cac, rows):
+    chdir("accounts")
+    accounts = 0
+    while exists(f"config{accounts+1}.csv"):
+        remove(f"ledger{accounts+1}.db")
+        accounts += 1
+    return accounts * rows
+
+
+def work_accounts(cac, rows):
+    sys.argv = ["cac.py", "--addDateTime=False"]
+    cac.main()
+    return rows
+
+
+SERVER_LATENCY = 0.02
+
+
+def setup_server_accounts(engine):
+    # The accounts phase fetching from the local wallet stand-in: a fresh
+    # login with 2FA for every account, then the transaction page
+    def setup(cac, rows):
+        if cac.pyotpDisabledInternal or (engine == "async" and cac.aiohttpDisabledInternal):
+            return None
+        from .wallet import WalletServer, account_config
+        accounts = len(glob("accounts/config*.csv"))
+        server = WalletServer(accounts=accounts, rows=rows, latency=SERVER_LATENCY).start()
+        makedirs("server", exist_ok=True)
+        chdir("server")
+        for number in range(1, accounts + 1):
+            remove(f"cookie{number}.bin")
+            remove(f"ledger{number}.db")
+            account_config(f"config{number}.csv", server.base_url, number, fetchEngine=engine,
+                           totpMargin=0, silentMode=True, saveCSV=True)
+        return accounts * rows
+    return setup
+
+
+STARTUP_RUNS = 10
+
+
+def setup_startup(arguments, directory="."):
+    # Whole cac.py runs: interpreter start, imports and (for cache replays)
+    # processing a cached account page over an up to date ledger
+    def setup(cac, rows):
+        chdir(directory)
+        command = [sys.executable, cac.__file__] + arguments
+        run(command, stdout=DEVNULL)
+        return command
+    return setup
+
+
+def work_startup(cac, command):
+    for x in range(STARTUP_RUNS):
+        run(command, stdout=DEVNULL)
+    return STARTUP_RUNS
+
+
+PHASES = {
+    "load_bitcoin_usd_cold": (setup_price_cold(BITSTAMP_FILE), work_load_bitcoin_usd),
+    "load_bitcoin_usd_warm": (setup_price_warm(BITSTAMP_FILE), work_load_bitcoin_usd),
+    "load_coinbasepro_usd_cold": (setup_price_cold(COINBASEPRO_FILE), work_load_coinbasepro_usd),
+    "load_coinbasepro_usd_warm": (setup_price_warm(COINBASEPRO_FILE), work_load_coinbasepro_usd),
+    "resume_coinbasepro_usd": (setup_price_warm(COINBASEPRO_FILE), work_resume_coinbasepro_usd),
+    "price_gaps": (setup_price_warm(COINBASEPRO_FILE), work_price_gaps),
+    "update_coinbasepro_usd": (setup_update_coinbasepro_usd, work_update_coinbasepro_usd),
+    "repair_price_gaps": (setup_repair_price_gaps, work_repair_price_gaps),
+    "fmv_day_vwap": (setup_price_windows("day_vwap"), work_price_windows),
+    "fmv_month_end": (setup_price_windows("month_end"), work_price_windows),
+    "parse": (setup_parse("lxml"), work_parse),
+    "parse_bs4": (setup_parse("bs4"), work_parse),
+    "process_transactions": (setup_process(False), work_process),
+    "process_transactions_ledger": (setup_process(True), work_process),
+    "gains_fifo": (setup_gains("FIFO"), work_gains),
+    "gains_hifo": (setup_gains("HIFO"), work_gains),
+    "write_csv": (setup_write_csv, work_write_csv),
+    "export_csv_gz": (setup_export("csv.gz"), work_export),
+    "export_jsonl": (setup_export("jsonl"), work_export),
+    "export_sqlite": (setup_export("sqlite"), work_export),
+    "sheet_cells": (setup_sheet_cells, work_sheet_cells),
+    "sheet_sync_full": (setup_sheet_sync("full"), work_sheet_sync),
+    "sheet_sync_append": (setup_sheet_sync("append"), work_sheet_sync),
+    "accounts": (setup_accounts, work_accounts),
+    "accounts_server": (setup_server_accounts("twill"), work_accounts),
+    "accounts_server_async": (setup_server_accounts("async"), work_accounts),
+    "startup_exit": (setup_startup(["-exit"]), work_startup),
+    "startup_cache": (setup_startup(["--config=1", "--addDateTime=False"], "accounts"), work_startup),
+}
+
+
+def run_phase(phase, rows, data_dir, package_dir):
+    chdir(data_dir)
+    if package_dir not in sys.path:
+        sys.path.insert(0, package_dir)
+    with open(devnull, "w") as quiet, redirect_stdout(quiet):
+        import cac
+        setup, work = PHASES[phase]
+        state = setup(cac, rows)
+        if state is None:
+            return None
+        wall = perf_counter()
+        cpu = process_time()
+        count = work(cac, state)
+        cpu = process_time() - cpu
+        wall = perf_counter() - wall
+
+    return {
+        "phase": phase,
+        "rows": count,
+        "seconds": wall,
+        "cpu_seconds": cpu,
+        "rows_per_second": count / wall if wall > 0 else None,
+        "peak_rss_kb": peak_rss_kb(),
+    }
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+Synthetic wallet pages, price files and account configs for the benchmarks.
+
+Everything is generated from a seed so runs on different versions of cac.py
+see the same input.
+"""
+
+from os import makedirs
+from os.path import join
+from random import Random
+from time import gmtime, strftime
+
+YEAR_START = 1609459200  # 2021-01-01 00:00 UTC
+
+
+def wallet_date(epoch):
+    # Wallet style date, e.g. "Jan 5, 2021 9:38 AM" (no zero padding)
+    t = gmtime(epoch)
+    hour = t.tm_hour % 12
+    if hour == 0:
+        hour = 12
+    ampm = "AM" if t.tm_hour < 12 else "PM"
+    return f"{strftime('%b', t)} {t.tm_mday}, {t.tm_year} {hour}:{t.tm_min:02d} {ampm}"
+
+
+def transaction_rows(rows, seed=0, miners=50, start=YEAR_START):
+    # Yields (line1, line2, line3) of each transaction link, oldest first.
+    # Mostly miner payouts with a few deposits and withdrawals, spread over
+    # a year (or longer when there are more rows than minutes).
+    rnd = Random(seed)
+    span = max(365 * 86400, rows * 60)
+    step = max(60, span // max(rows, 1) // 60 * 60)
+    epoch = start
+    for x in range(rows):
+        epoch += step
+        amount = f"0.{rnd.randint(1000, 9999999):08d}"
+        r = rnd.random()
+        if r < 0.02:
+            yield "Withdraw BTC", wallet_date(epoch), f"- {amount} BTC"
+        elif r < 0.05:
+            yield "Deposit BTC", wallet_date(epoch), f"+ {amount} BTC"
+        else:
+            miner = rnd.randint(1000, 1000 + miners - 1)
+            yield f"Miner Deposit {miner}:", wallet_date(epoch), f"+ {amount} BTC"
+
+
+def transaction_html(rows, seed=0, miners=50):
+    # A transaction/btc page: navigation links plus one <a> per transaction,
+    # newest first, in the same shape the wallet returns
+    links = [f'<a href="/transaction/btc/{x}" class="list-group-item">{line1}\n{line2}\n{line3}</a>'
+             for x, (line1, line2, line3) in enumerate(transaction_rows(rows, seed, miners))]
+    links.reverse()
+    return ('<!DOCTYPE html>\n<html><head><title>Transactions</title></head><body>\n'
+            '<nav><a href="/wallet">Wallet</a> <a href="/logout">Logout</a></nav>\n'
+            '<div class="list-group">\n' + "\n".join(links) + '\n</div>\n</body></html>\n')
+
+
+def price_rows(minutes, seed=0, start=YEAR_START):
+    # Random walk minute candles: (epoch, open, high, low, close, volume)
+    rnd = Random(seed)
+    price = 29000.0
+    for x in range(minutes):
+        open_ = price
+        price = max(1000.0, price + rnd.gauss(0, 25))
+        high = max(open_, price) + rnd.random() * 10
+        low = min(open_, price) - rnd.random() * 10
+        yield start + 60 * x, round(open_, 2), round(high, 2), round(low, 2), round(price, 2), round(rnd.random() * 5, 8)
+
+
+def bitstamp_csv(file_name, minutes, seed=0, currency="USD"):
+    # CryptoDataDownload layout: two header lines, newest row first
+    rows = list(price_rows(minutes, seed))
+    with open(file_name, "w") as f:
+        f.write("https://www.CryptoDataDownload.com\n")
+        f.write(f"unix,date,symbol,open,high,low,close,Volume BTC,Volume {currency}\n")
+        for epoch, open_, high, low, close, volume in reversed(rows):
+            date = strftime("%Y-%m-%d %H:%M:%S", gmtime(epoch))
+            f.write(f"{epoch},{date},BTC/{currency},{open_},{high},{low},{close},{volume},{round(volume*close, 2)}\n")
+
+
+def coinbasepro_csv(file_name, minutes, seed=0):
+    # cac.py's own coinbasepro.csv layout, oldest row first, no header
+    with open(file_name, "w") as f:
+        for epoch, open_, high, low, close, volume in price_rows(minutes, seed):
+            date = strftime("%Y-%m-%d %H:%M:%S", gmtime(epoch))
+            f.write(f"{epoch},{date},BTC/USD,{float(open_)},{float(high)},{float(low)},{float(close)},{float(volume)}\n")
+
+
+def account_configs(directory, accounts, rows, seed=0):
+    # config<N>.csv files replaying cache<N>.bin pages, so main() runs offline
+    makedirs(directory, exist_ok=True)
+    for number in range(1, accounts + 1):
+        with open(join(directory, f"config{number}.csv"), "w") as f:
+            f.write('run_mode,"Automatic"\n')
+            f.write('cache,"True"\n')
+            f.write('saveCSV,"True"\n')
+            f.write('silentMode,"True"\n')
+        with open(join(directory, f"cache{number}.bin"), "w") as f:
+            f.write(transaction_html(rows, seed + number))
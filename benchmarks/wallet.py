@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+"""
+A local stand-in for the wallet site, so login, 2FA, the support notice,
+retries and whole ./cac.py runs can be tested and timed offline:
+
+    python -m benchmarks.wallet [--port=8765] [--accounts=4] [--rows=1000]
+                                [--latency=0.05] [--failRate=0.1]
+                                [--rejectCodes=1] [--supportNotice=True] [--seed=0]
+
+Account N logs in as userN@example.com with password "password" and 2FA
+secret TOTP_SECRET; point a config at it with baseURL (printed on start).
+GET /stats returns request counts as JSON.
+"""
+
+import json
+from base64 import b32decode
+from hashlib import sha1
+from hmac import new as hmac_new
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from random import Random
+from secrets import token_hex
+from struct import pack, unpack_from
+from sys import argv
+from threading import Lock, Thread
+from time import sleep, time
+from urllib.parse import parse_qs
+
+from .synthetic import transaction_html
+
+TOTP_SECRET = "JBSWY3DPEHPK3PXP"
+PASSWORD = "password"
+
+LOGIN_FORM = ('<html><body><form name="login" method="post" action="/login">'
+              '<input type="email" name="email"><input type="password" name="password">'
+              '<input type="submit" value="Login"></form></body></html>')
+AUTH_FORM = ('<html><body><form name="authCheck" method="post" action="/auth">'
+             '<input type="text" name="authCode"><input type="submit" value="Verify"></form></body></html>')
+
+
+def totp_code(secret, epoch, step=30):
+    # RFC 6238 six digit code, the same as pyotp's TOTP(secret).at(epoch)
+    key = b32decode(secret.upper() + "=" * (-len(secret) % 8))
+    digest = hmac_new(key, pack(">Q", int(epoch) // step), sha1).digest()
+    offset = digest[-1] & 0x0f
+    return f"{(unpack_from('>I', digest, offset)[0] & 0x7fffffff) % 1000000:06d}"
+
+
+def username(number):
+    return f"user{number}@example.com"
+
+
+class Wallet:
+    # Accounts, sessions and the failure settings shared by request threads
+    def __init__(self, accounts=4, rows=1000, latency=0.0, fail_rate=0.0, reject_codes=0,
+                 support_notice=False, secret=TOTP_SECRET, seed=0):
+        self.pages = {username(x): transaction_html(rows, seed + x) for x in range(1, accounts + 1)}
+        self.latency = latency
+        self.fail_rate = fail_rate
+        self.reject_codes = reject_codes
+        self.support_notice = support_notice
+        self.secret = secret
+        self.random = Random(seed)
+        self.sessions = {}  # cookie -> {"user", "state", "rejected"}
+        self.stats = {}
+        self.lock = Lock()
+
+    def count(self, key):
+        with self.lock:
+            self.stats[key] = self.stats.get(key, 0) + 1
+
+    def fails(self):
+        with self.lock:
+            return self.random.random() < self.fail_rate
+
+    def login(self, email, password):
+        if email not in self.pages or password != PASSWORD:
+            return None
+        cookie = token_hex(16)
+        with self.lock:
+            self.sessions[cookie] = {"user": email, "state": "2fa", "rejected": 0}
+        return cookie
+
+    def check_code(self, session, code):
+        # Valid codes are those of the current 30 second window; the first
+        # reject_codes valid codes of a session are refused anyway
+        if code != totp_code(self.secret, time()):
+            return False
+        if session["rejected"] < self.reject_codes:
+            session["rejected"] += 1
+            return False
+        return True
+
+
+class WalletHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def session(self):
+        for part in self.headers.get("Cookie", "").split(";"):
+            name, _, value = part.strip().partition("=")
+            if name == "wallet_session" and value in self.server.wallet.sessions:
+                return self.server.wallet.sessions[value]
+        return None
+
+    def send(self, code, body="", headers=()):
+        data = body.encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(data)
+        self.server.wallet.count(f"{self.command} {self.path.split('?')[0]} {code}")
+
+    def redirect(self, location, headers=()):
+        self.send(302, "", [("Location", location)] + list(headers))
+
+    def begin(self):
+        # Latency and injected server errors; False when the request failed
+        wallet = self.server.wallet
+        if wallet.latency > 0:
+            sleep(wallet.latency)
+        if self.path != "/stats" and wallet.fails():
+            self.send(wallet.random.choice([500, 502, 503, 504]), "<html>Server Error</html>")
+            return False
+        return True
+
+    def do_HEAD(self):
+        self.do_GET()
+
+    def do_GET(self):
+        if not self.begin():
+            return
+        wallet = self.server.wallet
+        path = self.path.split('?')[0]
+        session = self.session()
+        if path == "/stats":
+            with wallet.lock:
+                return self.send(200, json.dumps(wallet.stats, indent=1, sort_keys=True))
+        if path == "/login":
+            return self.send(200, LOGIN_FORM)
+        if path == "/auth":
+            if session is None or session["state"] != "2fa":
+                return self.redirect("/login")
+            return self.send(200, AUTH_FORM)
+        if session is None or session["state"] not in ["notice", "ok"]:
+            return self.redirect("/login")
+        if path.startswith("/support"):
+            return self.send(200, "<html><body>Support notice</body></html>")
+        if session["state"] == "notice":
+            if path == "/wallet":
+                session["state"] = "ok"  # the wallet page dismisses it
+                return self.redirect("/")
+            return self.redirect("/support/notice")
+        if path == "/":
+            return self.send(200, "<html><body>Summary</body></html>")
+        if path == "/wallet":
+            return self.send(200, "<html><body>Wallet</body></html>")
+        if path == "/transaction/btc":
+            return self.send(200, wallet.pages[session["user"]])
+        self.send(404, "<html>Not Found</html>")
+
+    def do_POST(self):
+        data = parse_qs(self.rfile.read(int(self.headers.get("Content-Length", 0))).decode("utf-8"))
+        if not self.begin():
+            return
+        wallet = self.server.wallet
+        path = self.path.split('?')[0]
+        session = self.session()
+        if path == "/login":
+            cookie = wallet.login(data.get("email", [""])[0], data.get("password", [""])[0])
+            if cookie is None:
+                return self.redirect("/login")
+            return self.redirect("/auth", [("Set-Cookie", f"wallet_session={cookie}; Path=/")])
+        if path == "/auth":
+            if session is None or session["state"] != "2fa":
+                return self.redirect("/login")
+            if not wallet.check_code(session, data.get("authCode", [""])[0]):
+                return self.send(422, AUTH_FORM)
+            session["state"] = "notice" if wallet.support_notice else "ok"
+            return self.redirect("/")
+        self.send(404, "<html>Not Found</html>")
+
+
+class WalletServer:
+    # Runs the stand-in on a background thread; port 0 picks a free port
+    def __init__(self, port=0, **options):
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", port), WalletHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.wallet = Wallet(**options)
+        self.thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.httpd.server_address[1]}/"
+
+    @property
+    def stats(self):
+        return dict(self.httpd.wallet.stats)
+
+    def start(self):
+        self.thread = Thread(target=self.httpd.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def account_config(file_name, base_url, number, secret=TOTP_SECRET, **options):
+    # A config<N>.csv that logs in to the stand-in as account number
+    with open(file_name, "w") as f:
+        f.write('run_mode,"Automatic"\n')
+        f.write(f'baseURL,"{base_url}"\n')
+        f.write(f'username,"{username(number)}"\n')
+        f.write(f'password,"{PASSWORD}"\n')
+        f.write(f'auth_2fa,"{secret}"\n')
+        for key, value in options.items():
+            f.write(f'{key},"{value}"\n')
+
+
+def main():
+    options = {"port": "8765", "accounts": "4", "rows": "1000", "latency": "0",
+               "failRate": "0", "rejectCodes": "0", "supportNotice": "False", "seed": "0"}
+    for arg in argv[1:]:
+        if arg[0:2] != "--" or '=' not in arg:
+            assert False, f"Argument '{arg}' not valid!"
+        key, value = arg[2:].split('=', 1)
+        options[key] = value
+
+    server = WalletServer(int(options["port"]), accounts=int(options["accounts"]),
+                          rows=int(options["rows"]), latency=float(options["latency"]),
+                          fail_rate=float(options["failRate"]), reject_codes=int(options["rejectCodes"]),
+                          support_notice=options["supportNotice"] == "True", seed=int(options["seed"]))
+    print(f"Wallet stand-in at {server.base_url}")
+    print(f'  baseURL,"{server.base_url}"')
+    print(f'  username,"{username(1)}" (to user{options["accounts"]}@example.com)')
+    print(f'  password,"{PASSWORD}"')
+    print(f'  auth_2fa,"{TOTP_SECRET}"')
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(json.dumps(server.stats, indent=1, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
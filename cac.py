@@ -9,22 +9,48 @@ Created on Mon Oct 25 19:28:42 2021
 """
 
 from datetime import datetime, timedelta
-from time import time, localtime, strftime, strptime, mktime, sleep
-from os import environ, unlink
-from os.path import basename, exists, getmtime
+from time import time, localtime, strftime, strptime, mktime, sleep, monotonic, perf_counter, thread_time
+from os import environ, unlink, replace, makedirs, cpu_count
+from os.path import basename, exists, getmtime, getsize, splitext, join, isdir
 from sys import argv, exit, version_info
-from csv import reader as csvreader
-from re import sub
+import sys
+from csv import reader as csvreader, writer as csvwriter
+from gzip import open as gzip_open, compress as gzip_compress, decompress as gzip_decompress
+from hashlib import sha256
+from re import compile as re_compile
+from array import array
+from bisect import bisect_left, bisect_right
+from mmap import mmap, ACCESS_READ
+from struct import pack, unpack_from
+from sqlite3 import connect as sqlite_connect
+from glob import glob
+from io import StringIO
+from threading import Lock, get_ident
+from contextvars import ContextVar
+from collections import deque
+from heapq import heappush, heappop
+from itertools import islice
+from random import uniform
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_all_start_methods, get_context
+from contextlib import redirect_stdout
+from importlib.util import find_spec
+import json
 from getpass import getpass as getpassword
 
 assert version_info >= (3, 7), "Python 3.7+ required."
 
 
-# (Required) external modules
-try:
-    from twill.commands import reset_browser, log, go, fv, submit, save_html, browser, load_cookies, save_cookies, getinput
-    from bs4 import BeautifulSoup
-except:
+def module_available(name):
+    # Checks for a module without importing it
+    try:
+        return find_spec(name) is not None
+    except (ImportError, ValueError):
+        return False
+
+
+# (Required) external modules, imported by load_twill() etc. when first used
+if not (module_available("twill") and module_available("bs4") and module_available("lxml")):
     assert False, "Install requirements.txt Python modules first..."
 
 
@@ -35,113 +61,1112 @@ try:
 except:
     tzsetDisabledInternal = True
 
-try:
-    from pytz import timezone as pytz_timezone
-    pytzDisabledInternal = False
-except:
-    pytzDisabledInternal = True
+pytzDisabledInternal = not module_available("pytz")
+zoneinfoDisabledInternal = not module_available("zoneinfo")
 
 
 # (Optional) 2FA Support
-try:
-    from pyotp import TOTP
-    pyotpDisabledInternal = False
-except:
-    pyotpDisabledInternal = True
+pyotpDisabledInternal = not module_available("pyotp")
 
 
 # (Optional) Google Sheets Support
-try:
+gspredDisabledInternal = not (module_available("gspread") and module_available("google.oauth2"))
+
+cbpDisabledInternal = not module_available("coinbasepro")
+
+# (Optional) fetchEngine "async"
+aiohttpDisabledInternal = not module_available("aiohttp")
+
+# (Optional) zstd compressed snapshots
+zstdDisabledInternal = not module_available("zstandard")
+cbp_client = None
+
+
+def load_twill():
+    global log, getinput, TwillBrowser, twill_utils
+    from twill.commands import log, getinput
+    from twill.browser import TwillBrowser
+    from twill import utils as twill_utils
+
+
+def load_bs4():
+    global BeautifulSoup
+    from bs4 import BeautifulSoup
+
+
+def load_lxml():
+    global HTMLPullParser, html_fromstring
+    from lxml.etree import HTMLPullParser
+    from lxml.html import fromstring as html_fromstring
+
+
+def load_aiohttp():
+    global asyncio, aiohttp
+    import asyncio
+    import aiohttp
+
+
+def load_zstd():
+    global zstandard
+    import zstandard
+
+
+def load_pytz():
+    global pytz_timezone, AmbiguousTimeError, NonExistentTimeError
+    from pytz import timezone as pytz_timezone
+    from pytz.exceptions import AmbiguousTimeError, NonExistentTimeError
+
+
+def load_pyotp():
+    global TOTP
+    from pyotp import TOTP
+
+
+def load_gspread():
+    global authorize, Cell, service_account
     from gspread import authorize, Cell
     from google.oauth2 import service_account
-    gspredDisabledInternal = False
-except:
-    gspredDisabledInternal = True
 
-try:
-    from coinbasepro import PublicClient
-    cbpDisabledInternal = False
-    cbp_client = PublicClient()
-except:
-    cbpDisabledInternal = True
+
+def get_cbp_client():
+    # Coinbase Pro client, created on first use
+    global cbp_client
+    if cbp_client is None:
+        from coinbasepro import PublicClient
+        cbp_client = PublicClient()
+    return cbp_client
+
+
+PRICE_MAGIC = b"CACPRICE"
+AGGREGATE_MAGIC = b"CACAGGR1"
+INDEX_MAGIC = b"CACINDX1"
+PRICE_FIELDS = ("open", "high", "low", "close", "volume")
+
+
+class PriceSegment:
+    # One sorted run of minute prices: int64 epochs plus float64 OHLCV columns
+    def __init__(self, epochs, columns, source=None):
+        self.epochs = epochs
+        self.columns = dict(zip(PRICE_FIELDS, columns))
+        self.source = source
+        self.aggregate_file = None
+        self.prefix = None
+
+    def __len__(self):
+        return len(self.epochs)
+
+    def aggregates(self):
+        # Prefix sums of close, close*volume and volume (n+1 entries each),
+        # so any window's average and VWAP costs two bisects
+        if self.prefix is None and self.aggregate_file is not None:
+            if exists(self.aggregate_file) and getmtime(self.aggregate_file) >= getmtime(self.source):
+                self.prefix = load_aggregate_sidecar(self.aggregate_file, len(self))
+        if self.prefix is None:
+            self.prefix = build_aggregates(self)
+            if self.aggregate_file is not None:
+                save_aggregate_sidecar(self.aggregate_file, self.prefix)
+        return self.prefix
+
+    def window(self, t0, t1):
+        # (minutes, sum close, sum close*volume, sum volume, last close) in [t0, t1]
+        i = bisect_left(self.epochs, t0)
+        j = bisect_right(self.epochs, t1)
+        if j <= i:
+            return 0, 0.0, 0.0, 0.0, None
+        sum_close, sum_pv, sum_volume = self.aggregates()
+        return (j - i, sum_close[j] - sum_close[i], sum_pv[j] - sum_pv[i],
+                sum_volume[j] - sum_volume[i], self.columns["close"][j-1])
+
+
+class PriceStore:
+    # Epoch indexed price series searched with bisect instead of a dict of
+    # string lists.  CSV files are converted once into a binary ".bin" sidecar
+    # (native byte order) which is memory-mapped on later runs.
+    def __init__(self):
+        self.segments = []
+        self.sources = []  # DayIndex files loaded on demand by require()
+        self.tail = None
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments)
+
+    def add_source(self, source):
+        self.sources.append(source)
+
+    def require(self, ranges):
+        # Loads the days of every (t0, t1) range that lazy sources haven't
+        # read yet; returns the number of minutes added
+        return sum(source.load(ranges, self) for source in self.sources)
+
+    def load_csv(self, file_name):
+        sidecar = splitext(file_name)[0]+".bin"
+        segment = None
+        if exists(sidecar) and getmtime(sidecar) >= getmtime(file_name):
+            segment = load_price_sidecar(sidecar)
+        if segment is None:
+            segment = read_price_csv(file_name)
+            save_price_sidecar(sidecar, segment)
+        segment.source = file_name
+        segment.aggregate_file = splitext(file_name)[0]+".agg"
+        self.add_segment(segment)
+        return segment
+
+    def add_segment(self, segment):
+        if len(segment) == 0:
+            return
+        self.segments.append(segment)
+        self.segments.sort(key=lambda s: s.epochs[0])
+
+    def append(self, epoch, open_, high, low, close, volume):
+        # Newer rows (e.g. Coinbase Pro updates) go to an in-memory tail
+        if self.tail is None or (len(self.tail) and epoch <= self.tail.epochs[-1]):
+            self.tail = PriceSegment(array('q'), [array('d') for f in PRICE_FIELDS])
+        self.tail.epochs.append(epoch)
+        for field, value in zip(PRICE_FIELDS, (open_, high, low, close, volume)):
+            self.tail.columns[field].append(value)
+        self.tail.prefix = None
+        if len(self.tail) == 1:
+            self.add_segment(self.tail)
+
+    def last_epoch(self):
+        lasts = [segment.epochs[-1] for segment in self.segments]
+        lasts += [source.last for source in self.sources if source.last is not None]
+        if len(lasts) == 0:
+            return None
+        return max(lasts)
+
+    def find(self, epoch, match="exact"):
+        # Returns (segment, index) of the matching minute or None.
+        #   exact  - same epoch only
+        #   prior  - latest minute at or before epoch
+        #   minute - nearest minute within 60 seconds either side
+        best = None
+        for segment in self.segments:
+            epochs = segment.epochs
+            if match == "exact":
+                if epochs[0] <= epoch <= epochs[-1]:
+                    i = bisect_left(epochs, epoch)
+                    if epochs[i] == epoch:
+                        return segment, i
+                continue
+            i = bisect_right(epochs, epoch)
+            candidates = [i-1] if match == "prior" else [i-1, i]
+            for j in candidates:
+                if j < 0 or j >= len(epochs):
+                    continue
+                distance = abs(epoch - epochs[j])
+                if match == "minute" and distance > 60:
+                    continue
+                if best is None or distance < best[0]:
+                    best = (distance, segment, j)
+        if match not in ["exact", "prior", "minute"]:
+            assert False, f"Unknown price match '{match}'"
+        if best is None:
+            return None
+        return best[1], best[2]
+
+    def price(self, epoch, field="open", match="exact"):
+        found = self.find(epoch, match)
+        if found is None:
+            return None
+        segment, i = found
+        return segment.columns[field][i]
+
+    def window(self, t0, t1):
+        minutes, sum_close, sum_pv, sum_volume, close = 0, 0.0, 0.0, 0.0, None
+        for segment in self.segments:
+            if segment.epochs[-1] < t0 or segment.epochs[0] > t1:
+                continue
+            found = segment.window(t0, t1)
+            minutes += found[0]
+            sum_close += found[1]
+            sum_pv += found[2]
+            sum_volume += found[3]
+            if found[4] is not None:
+                close = found[4]  # segments are sorted, the last one wins
+        return minutes, sum_close, sum_pv, sum_volume, close
+
+    def average(self, t0, t1):
+        # Mean minute close over [t0, t1]
+        minutes, sum_close, sum_pv, sum_volume, close = self.window(t0, t1)
+        if minutes == 0:
+            return None
+        return sum_close / minutes
+
+    def vwap(self, t0, t1):
+        minutes, sum_close, sum_pv, sum_volume, close = self.window(t0, t1)
+        if minutes == 0:
+            return None
+        if sum_volume == 0:
+            return sum_close / minutes
+        return sum_pv / sum_volume
+
+    def close(self, t0, t1):
+        # Close of the last minute in [t0, t1]
+        return self.window(t0, t1)[4]
+
+    def gaps(self, t0, t1):
+        # Missing minutes in [t0, t1] of the loaded segments as sorted
+        # [(first missing, last missing)] ranges
+        runs = []
+        for segment in self.segments:
+            epochs = segment.epochs
+            if len(epochs) == 0 or epochs[-1] < t0 or epochs[0] > t1:
+                continue
+            runs += minute_runs(epochs[bisect_left(epochs, t0):bisect_right(epochs, t1)])
+        runs.sort()
+        return missing_minutes(runs, t0, t1)
+
+
+def read_price_csv(file_name):
+    with open(file_name, mode='r', newline='') as file:
+        return parse_price_lines(file, file_name)
+
+
+def parse_price_lines(lines, source=None):
+    # Bitstamp: unix,date,symbol,open,high,low,close,volume,... (newest first)
+    # Coinbase Pro: epoch,date,BTC/USD,open,high,low,close,volume (oldest first)
+    rows = {}
+    for line in csvreader(lines):
+        if len(line) < 8:
+            continue
+        try:
+            epoch = int(float(line[0]))
+            values = tuple(float(x) for x in line[3:8])
+        except ValueError:
+            continue  # header lines
+        if epoch > 100000000000:
+            epoch //= 1000  # millisecond timestamps
+        rows[epoch] = values
+
+    epochs = array('q', sorted(rows))
+    columns = [array('d') for f in PRICE_FIELDS]
+    for epoch in epochs:
+        for column, value in zip(columns, rows[epoch]):
+            column.append(value)
+    return PriceSegment(epochs, columns, source)
+
+
+def line_epoch(line):
+    # Epoch of a price file line (bytes), or None for headers and partial lines
+    fields = line.split(b',')
+    if len(fields) < 8:
+        return None
+    try:
+        epoch = int(float(fields[0]))
+    except ValueError:
+        return None
+    if epoch > 100000000000:
+        epoch //= 1000
+    return epoch
+
+
+def last_line_epoch(file_name, size, block=4096):
+    # Seeks backwards from size to the newest complete line
+    with open(file_name, "rb") as f:
+        end = size
+        while end > 0:
+            start = max(0, end - block)
+            f.seek(start)
+            data = f.read(size - start)
+            lines = data.split(b"\n")
+            if data[-1:] != b"\n":
+                lines.pop()  # unfinished last line
+            if start > 0:
+                lines = lines[1:]  # may start mid line
+            for line in reversed(lines):
+                epoch = line_epoch(line)
+                if epoch is not None:
+                    return epoch
+            end = start
+            block *= 2
+    return None
+
+
+class DayIndex:
+    # Lazy access to an append-only, oldest first minute file (coinbasepro.csv).
+    # A ".idx" sidecar lists the file offset of the first row of every UTC day
+    # and how much of the file it covers; new rows are indexed by reading only
+    # what was appended.  Days are parsed into PriceSegments when require()d.
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.index_file = splitext(file_name)[0]+".idx"
+        self.days = array('q')
+        self.offsets = array('q')
+        self.size = 0
+        self.loaded = set()
+        self.open()
+
+    def open(self):
+        size = getsize(self.file_name)
+        indexed = self.read_index(size)
+        offset = self.size
+        with open(self.file_name, "rb") as f:
+            f.seek(offset)
+            for line in f:
+                if line[-1:] != b"\n":
+                    break  # only whole lines are indexed
+                epoch = line_epoch(line)
+                if epoch is not None:
+                    day = epoch - epoch % 86400
+                    if len(self.days) == 0 or day > self.days[-1]:
+                        self.days.append(day)
+                        self.offsets.append(offset)
+                offset += len(line)
+        if offset > self.size or indexed == 0:
+            self.size = offset
+            self.save_index(indexed)
+        self.last = last_line_epoch(self.file_name, self.size)
+
+    def read_index(self, size):
+        # Returns how many entries were already on disk
+        if not exists(self.index_file):
+            return 0
+        with open(self.index_file, "rb") as f:
+            data = f.read()
+        if data[0:8] != INDEX_MAGIC or len(data) < 16 or (len(data) - 16) % 16:
+            return 0
+        covered = unpack_from("<q", data, 8)[0]
+        entries = array('q', data[16:])
+        days, offsets = entries[0::2], entries[1::2]
+        if covered > size:
+            return 0  # file was truncated or replaced
+        if len(days) > 0:
+            # The last indexed day must still start where it did
+            with open(self.file_name, "rb") as f:
+                f.seek(offsets[-1])
+                epoch = line_epoch(f.readline())
+            if epoch is None or epoch - epoch % 86400 != days[-1]:
+                return 0
+        self.days, self.offsets, self.size = days, offsets, covered
+        return len(days)
+
+    def save_index(self, indexed):
+        entries = array('q')
+        for x in range(indexed, len(self.days)):
+            entries.append(self.days[x])
+            entries.append(self.offsets[x])
+        if indexed == 0:
+            with open(self.index_file+".tmp", "wb") as f:
+                f.write(INDEX_MAGIC + pack("<q", self.size))
+                entries.tofile(f)
+            replace(self.index_file+".tmp", self.index_file)
+            return
+        with open(self.index_file, "r+b") as f:
+            f.seek(16 + 16 * indexed)
+            entries.tofile(f)
+            f.seek(8)
+            f.write(pack("<q", self.size))
+
+    def load(self, ranges, store):
+        # Reads each run of wanted, not yet loaded days with one read.  A day
+        # either side is included so prior/minute matches and local days that
+        # cross UTC midnight find their neighbours.
+        wanted = set()
+        for t0, t1 in set(ranges):
+            first = bisect_right(self.days, t0 - 86400) - 1
+            last = bisect_right(self.days, t1 + 86400)
+            wanted.update(x for x in range(max(first, 0), last) if x not in self.loaded)
+        minutes = 0
+        with open(self.file_name, "rb") as f:
+            for run in day_runs(sorted(wanted)):
+                start = self.offsets[run[0]]
+                end = self.offsets[run[-1]+1] if run[-1]+1 < len(self.offsets) else self.size
+                f.seek(start)
+                segment = parse_price_lines(f.read(end - start).decode().splitlines(), self.file_name)
+                store.add_segment(segment)
+                self.loaded.update(run)
+                minutes += len(segment)
+        return minutes
+
+
+def day_runs(positions):
+    # [1, 2, 3, 7, 8] -> [[1, 2, 3], [7, 8]]
+    runs = []
+    for x in positions:
+        if len(runs) and runs[-1][-1] == x - 1:
+            runs[-1].append(x)
+        else:
+            runs.append([x])
+    return runs
+
+
+def minute_runs(epochs):
+    # Sorted epochs -> [(first, last)] runs of consecutive minutes
+    runs = []
+    first = previous = None
+    for epoch in epochs:
+        if previous is None or epoch - previous > 60:
+            if previous is not None:
+                runs.append((first, previous))
+            first = epoch
+        previous = epoch
+    if previous is not None:
+        runs.append((first, previous))
+    return runs
+
+
+def missing_minutes(runs, t0, t1):
+    # The minutes of [t0, t1] not in any of the sorted (first, last) runs
+    gaps = []
+    covered = t0 - 60
+    for first, last in runs:
+        if first - covered > 60 and first > t0:
+            gaps.append((covered + 60, min(first - 60, t1)))
+        covered = max(covered, last)
+        if covered >= t1:
+            break
+    if t1 - covered >= 60:
+        gaps.append((covered + 60, t1))
+    return gaps
+
+
+def save_price_sidecar(file_name, segment):
+    with open(file_name+".tmp", "wb") as f:
+        f.write(PRICE_MAGIC + pack("<q", len(segment)))
+        array('q', segment.epochs).tofile(f)
+        for field in PRICE_FIELDS:
+            array('d', segment.columns[field]).tofile(f)
+    replace(file_name+".tmp", file_name)
+
+
+def build_aggregates(segment):
+    sum_close, sum_pv, sum_volume = array('d', [0.0]), array('d', [0.0]), array('d', [0.0])
+    total_close = total_pv = total_volume = 0.0
+    for close, volume in zip(segment.columns["close"], segment.columns["volume"]):
+        total_close += close
+        total_pv += close * volume
+        total_volume += volume
+        sum_close.append(total_close)
+        sum_pv.append(total_pv)
+        sum_volume.append(total_volume)
+    return sum_close, sum_pv, sum_volume
+
+
+def save_aggregate_sidecar(file_name, prefix):
+    with open(file_name+".tmp", "wb") as f:
+        f.write(AGGREGATE_MAGIC + pack("<q", len(prefix[0])))
+        for column in prefix:
+            array('d', column).tofile(f)
+    replace(file_name+".tmp", file_name)
+
+
+def load_aggregate_sidecar(file_name, count):
+    with open(file_name, "rb") as f:
+        try:
+            mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            return None
+    if mm[0:8] != AGGREGATE_MAGIC or unpack_from("<q", mm, 8)[0] != count + 1:
+        return None
+    if len(mm) != 16 + 3 * 8 * (count + 1):
+        return None
+    view = memoryview(mm)
+    size = 8 * (count + 1)
+    return tuple(view[16+size*x:16+size*(x+1)].cast('d') for x in range(3))
+
+
+def load_price_sidecar(file_name):
+    with open(file_name, "rb") as f:
+        try:
+            mm = mmap(f.fileno(), 0, access=ACCESS_READ)
+        except ValueError:
+            return None  # empty file
+    if mm[0:8] != PRICE_MAGIC:
+        return None
+    count = unpack_from("<q", mm, 8)[0]
+    if len(mm) != 16 + 48 * count:
+        return None
+    view = memoryview(mm)
+    epochs = view[16:16+8*count].cast('q')
+    columns = []
+    for x in range(len(PRICE_FIELDS)):
+        start = 16 + 8*count*(x+1)
+        columns.append(view[start:start+8*count].cast('d'))
+    return PriceSegment(epochs, columns, file_name)
 
 
 default_timezone = "America/Toronto"
 configs = []
 args = {}
-bitcoin = {}
+# The series of the account being processed, see use_currency()
+bitcoin = PriceStore()
 bitcoin_loaded = False
 bitcoin_currancy = ""
 
+# currency: (symbol, Bitstamp minute files); USD also uses coinbasepro.csv
+CURRENCIES = {
+    "USD": ("$", "Bitstamp_BTCUSD_{}_minute.csv"),
+    "EUR": ("€", "Bitstamp_BTCEUR_{}_minute.csv"),
+}
+PRICE_YEARS = ["2021", "2022", "2023"]
+# Loaded series by currency (None when there are no price files), shared
+# by every account that uses the currency
+prices = {}
+
+
+class Profiler:
+    # Timing spans for --profile=json|chrome.  Spans are tagged with the
+    # account (config file) they belong to and the thread that ran them.
+    def __init__(self, trace_format, file_name, memory=False, parse_file=None):
+        self.trace_format = trace_format
+        self.file_name = file_name
+        self.memory = memory
+        self.parse_file = parse_file
+        self.parse_profile = None
+        self.spans = []
+        global tracemalloc, cProfile
+        import tracemalloc
+        import cProfile
+        self.lock = Lock()
+        self.started = perf_counter()
+        if memory:
+            tracemalloc.start()
+        if parse_file is not None:
+            self.parse_profile = cProfile.Profile()
+
+    def begin(self, name, account=""):
+        record = {"name": name, "account": account, "thread": get_ident(),
+                  "start": perf_counter() - self.started, "cpu": thread_time(), "args": {}}
+        if self.memory:
+            record["memory"] = tracemalloc.get_traced_memory()[0]
+        return record
+
+    def end(self, record, **counts):
+        record["wall"] = perf_counter() - self.started - record["start"]
+        record["cpu"] = thread_time() - record["cpu"]
+        record["args"].update(counts)
+        if self.memory:
+            record["allocated_kb"] = (tracemalloc.get_traced_memory()[0] - record.pop("memory")) / 1024
+        with self.lock:
+            self.spans.append(record)
+
+    def summary(self):
+        accounts = {}
+        for record in self.spans:
+            account = accounts.setdefault(record["account"] or "(run)", {})
+            phase = account.setdefault(record["name"], {"calls": 0, "wall": 0.0, "cpu": 0.0})
+            phase["calls"] += 1
+            phase["wall"] += record["wall"]
+            phase["cpu"] += record["cpu"]
+            for key, value in list(record["args"].items()) + [("allocated_kb", record.get("allocated_kb"))]:
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    phase[key] = phase.get(key, 0) + value
+        return accounts
+
+    def save(self):
+        if self.trace_format == "chrome":
+            events = []
+            for record in self.spans:
+                args = dict(record["args"], cpu_ms=record["cpu"] * 1000)
+                if "allocated_kb" in record:
+                    args["allocated_kb"] = record["allocated_kb"]
+                events.append({"name": record["name"], "cat": record["account"] or "run", "ph": "X",
+                               "ts": record["start"] * 1000000, "dur": record["wall"] * 1000000,
+                               "pid": 1, "tid": record["thread"], "args": args})
+            report = {"traceEvents": events, "displayTimeUnit": "ms"}
+        else:
+            report = {"total_seconds": perf_counter() - self.started,
+                      "accounts": self.summary(), "spans": self.spans}
+        with open(self.file_name, "w") as f:
+            json.dump(report, f, indent=1)
+
+        if self.parse_profile is not None:
+            self.parse_profile.dump_stats(self.parse_file)
+        if self.memory:
+            tracemalloc.stop()
+
+
+profiler = None
+
+
+def start_profiler(args):
+    global profiler
+    if "profile" not in args:
+        return
+    trace_format = args["profile"]
+    assert trace_format in ["json", "chrome"], "--profile must be json or chrome"
+    default_file = "profile.json" if trace_format == "json" else "profile.trace.json"
+    profiler = Profiler(trace_format, args.get("profileFile", default_file),
+                        args.get("profileMemory", False) == True, args.get("profileParse"))
+
+
+def stop_profiler():
+    global profiler
+    if profiler is not None:
+        profiler.save()
+        print("Profile saved to", profiler.file_name)
+        profiler = None
+
+
+class Span:
+    def __init__(self, name, account):
+        self.name = name
+        self.account = account
+        self.counts = {}
+
+    def start(self):
+        self.record = profiler.begin(self.name, self.account) if profiler is not None else None
+        self.started = perf_counter()
+        return self.counts
+
+    def stop(self):
+        if self.record is not None and profiler is not None:
+            profiler.end(self.record, **self.counts)
+        if metrics is not None:
+            metrics.observe(self.name, self.account, perf_counter() - self.started, self.counts)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+        return False
+
+
+# (metric, help, span, span count)
+METRICS = [
+    ("cac_login_attempts", "Login loop attempts", "login", "attempts"),
+    ("cac_login_retries", "Login attempts retried after a failure", "login", "retries"),
+    ("cac_totp_failures", "2FA codes refused with 422", "login", "totp_failures"),
+    ("cac_fetch_seconds", "Seconds to get the transaction page", "fetch", "seconds"),
+    ("cac_page_bytes", "Size of the transaction page", "fetch", "bytes"),
+    ("cac_transactions_new", "Transactions added to the ledger", "parse", "rows"),
+    ("cac_transactions_total", "Transactions in the ledger", "select", "rows"),
+    ("cac_transactions_selected", "Transactions selected for the outputs", "select", "selected"),
+    ("cac_transactions_unpriced", "Selected transactions without an FMV", "select", "unpriced"),
+    ("cac_price_hits", "Transactions priced this run", "price", "hits"),
+    ("cac_price_misses", "Transactions with no price found this run", "price", "misses"),
+    ("cac_coinbasepro_windows", "Coinbase Pro windows downloaded", "update_coinbasepro_usd", "windows"),
+    ("cac_coinbasepro_candles", "Coinbase Pro minutes downloaded", "update_coinbasepro_usd", "rows"),
+    ("cac_sheet_cells", "Google Sheet cells written", "google_sheet", "cells"),
+]
+
+
+class Metrics:
+    # Per account totals of every span, written at the end of each run (and
+    # --watch cycle) as a Prometheus textfile (metricsFile, e.g. for the
+    # node_exporter textfile collector) and/or a JSON status (metricsJson)
+    def __init__(self, prom_file, json_file):
+        self.prom_file = prom_file
+        self.json_file = json_file
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self):
+        self.started = time()
+        self.accounts = {}
+
+    def observe(self, name, account, seconds, counts):
+        with self.lock:
+            phase = self.accounts.setdefault(account, {}).setdefault(name, {"calls": 0, "seconds": 0.0})
+            phase["calls"] += 1
+            phase["seconds"] += seconds
+            for key, value in counts.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    phase[key] = phase.get(key, 0) + value
+
+    def prometheus(self, accounts, failed):
+        lines = []
+
+        def metric(name, help_text, samples):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            for labels, value in samples:
+                label = ",".join(f'{key}="{text}"' for key, text in labels if text != "")
+                lines.append(f"{name}{{{label}}} {value}" if label else f"{name} {value}")
+
+        metric("cac_run_timestamp_seconds", "When the run finished", [((), round(time(), 3))])
+        metric("cac_run_duration_seconds", "Length of the run", [((), round(time() - self.started, 3))])
+        metric("cac_accounts_failed", "Accounts that failed", [((), len(failed))])
+        metric("cac_account_success", "1 if the account was fetched and processed",
+               [((("account", account),), int(account not in failed)) for account in accounts])
+        for name, help_text, phase, key in METRICS:
+            samples = [((("account", account),), round(phases[phase][key], 6))
+                       for account, phases in sorted(self.accounts.items())
+                       if phase in phases and key in phases[phase]]
+            if len(samples) > 0:
+                metric(name, help_text, samples)
+        for key, help_text in [("seconds", "Seconds spent in each phase"), ("calls", "Times each phase ran")]:
+            metric("cac_phase_"+key, help_text,
+                   [((("account", account), ("phase", phase)), round(values[key], 6) if key == "seconds" else values[key])
+                    for account, phases in sorted(self.accounts.items())
+                    for phase, values in sorted(phases.items())])
+        return "\n".join(lines) + "\n"
+
+    def save(self, accounts, failed):
+        with self.lock:
+            if self.prom_file:
+                with open(self.prom_file+".tmp", "w") as f:
+                    f.write(self.prometheus(accounts, failed))
+                replace(self.prom_file+".tmp", self.prom_file)
+            if self.json_file:
+                status = {"timestamp": round(time(), 3), "duration_seconds": round(time() - self.started, 3),
+                          "failed": failed,
+                          "accounts": {account: dict(self.accounts.get(account, {}), success=account not in failed)
+                                       for account in accounts}}
+                if "" in self.accounts:
+                    status["run"] = self.accounts[""]
+                with open(self.json_file+".tmp", "w") as f:
+                    json.dump(status, f, indent=1)
+                replace(self.json_file+".tmp", self.json_file)
+
+
+metrics = None
+
+
+def start_metrics(config):
+    global metrics
+    if metrics is None and (config["metricsFile"] or config["metricsJson"]):
+        metrics = Metrics(config["metricsFile"], config["metricsJson"])
+
+
+def save_metrics(configs, failed):
+    # failed is None when the run stopped on an error
+    if metrics is None:
+        return
+    accounts = [config["configFile"] for config in configs]
+    metrics.save(accounts, accounts if failed is None else failed)
+
+
+def span(name, config=None):
+    # with span("parse", config) as counts: ... counts["rows"] = n
+    return Span(name, config.get("configFile", "") if config is not None else "")
+
+
+def wait(seconds, config=None):
+    # sleep() that shows up in --profile output
+    with span("sleep", config) as counts:
+        counts["seconds"] = seconds
+        sleep(seconds)
+
 
 def main():
     # Process Command Line Arguments
     global args
     args = process_command_arguments()
+    start_profiler(args)
+    try:
+        if "watch" in args:
+            watch(float(args["watch"]))
+        else:
+            run_configs()
+    finally:
+        stop_profiler()
 
-    # Load Bitcoin Prices
-    global bitcoin_currancy
 
-    file_name = "coinbasepro.csv"
-    if not cbpDisabledInternal and exists(file_name):
-        update_coinbasepro_usd(file_name)
-        bitcoin_currancy = "$"
-        
-    if not bitcoin_loaded:
-        for year in ["2021", "2022", "2023"]:
-            file_name = "Bitstamp_BTCUSD_"+year+"_minute.csv"
-            if exists(file_name):
-                load_bitcoin_usd(file_name)
-                bitcoin_currancy = "$"
-                
-    if not bitcoin_loaded:
-        for year in ["2021", "2022", "2023"]:
-            file_name = "Bitstamp_BTCEUR_"+year+"_minute.csv"
-            if exists(file_name):
-                load_bitcoin_usd(file_name)
-                bitcoin_currancy = "€"
+def price_files(currency):
+    files = [CURRENCIES[currency][1].format(year) for year in PRICE_YEARS]
+    return [file_name for file_name in files if exists(file_name)]
+
+
+def coinbasepro_available():
+    return not cbpDisabledInternal and exists("coinbasepro.csv")
+
+
+def default_currency():
+    # Accounts without a currency use USD, or EUR when only EUR files exist
+    if coinbasepro_available() or price_files("USD") or not price_files("EUR"):
+        return "USD"
+    return "EUR"
+
 
+def load_prices(currency, update=True):
+    # Loads a currency's series the first time an account asks for it;
+    # update=False reads coinbasepro.csv without downloading new candles
+    global coinbasepro_file
+    if currency in prices:
+        return prices[currency]
+    assert currency in CURRENCIES, f"Unknown currency '{currency}'"
+
+    store = PriceStore()
+    with span("load_prices") as counts:
+        counts["currency"] = currency
+        if currency == "USD" and coinbasepro_available() and not update:
+            load_coinbasepro_usd("coinbasepro.csv", store)
+        elif currency == "USD" and coinbasepro_available():
+            update_coinbasepro_usd("coinbasepro.csv", store)
+            coinbasepro_file = "coinbasepro.csv"
+        else:
+            for file_name in price_files(currency):
+                load_bitcoin_usd(file_name, store)
+    prices[currency] = store if len(store.segments) or len(store.sources) else None
+    return prices[currency]
+
+
+def use_currency(config):
+    # Points bitcoin, bitcoin_loaded and bitcoin_currancy at the series of
+    # the account's currency (accounts are processed one at a time)
+    global bitcoin, bitcoin_loaded, bitcoin_currancy
+    currency = (config["currency"] or default_currency()).upper()
+    store = load_prices(currency)
+    bitcoin = store if store is not None else PriceStore()
+    bitcoin_loaded = store is not None
+    bitcoin_currancy = CURRENCIES[currency][0] if store is not None else ""
+
+
+def run_configs():
+    load_configs()
+    start_metrics(configs[0])
+    failed = None
+    try:
+        failed = run_cycle(configs)
+    finally:
+        save_metrics(configs, failed)
+    if len(failed) > 0:
+        exit(1)
+
+
+def load_configs():
     # Check if using multiple configs
-    validConfigs = ["1", "2", "3", "4", "5", "6", "7", "8", "9"]
-    if "config" in args:
-        validConfigs = args["config"]
-    new_config = False
-    for file_number in validConfigs:
-        if exists("config"+file_number+".csv"):
-            new_config = True
-            config = {"new_config": True}
-            # Set defaults
-            set_defaults(config, file_number)
-            # Load Config file
-            load_config(config)
-            # Update with command line arguments
-            config.update(args)
-            # Push config
-            configs.append(config)
-
-    if new_config:
-        for config in configs:
-            if not config["silentMode"]:
-                print("Config file", config["configFile"], "loaded...")
-                
-            if config["cache"] == True and exists(config["cacheFile"]):
-                with open(config["cacheFile"], "r") as htmlFile:
-                    process_transactions(config, htmlFile)
-            else:
-                html = load_transactions(config)
-                process_transactions(config, html)
-    else:
+    for file_number, file_name in find_config_files(args):
+        config = {"new_config": True}
+        # Set defaults
+        set_defaults(config, file_number)
+        config["configFile"] = file_name
+        # Load Config file
+        load_config(config)
+        # Update with command line arguments
+        config.update(args)
+        # Push config
+        configs.append(config)
+
+    if len(configs) == 0:
         config = {}
         set_defaults(config)
         load_config(config)
         config.update(args)
         configs.append(config)
-        if config["cache"] == True and exists(config["cacheFile"]):
+
+
+def run_cycle(configs):
+    # Fetches and processes every account once, returning the failed ones
+    if "new_config" in configs[0]:
+        return run_accounts(configs)
+    process_transactions(configs[0], fetch_transactions(configs[0]))
+    return []
+
+
+coinbasepro_file = None
+
+
+def watch(interval):
+    # --watch=<seconds>: refresh every account on a schedule in one process.
+    # Prices, login sessions and ledgers stay loaded between cycles, only
+    # new Coinbase Pro candles are downloaded and outputs are only rewritten
+    # when an account's ledger changed.
+    load_configs()
+    start_metrics(configs[0])
+    cycle = 0
+    try:
+        while True:
+            cycle += 1
+            started = monotonic()
+            print(strftime("%Y-%m-%d %H:%M:%S", localtime(time())), "Watch cycle", cycle)
+            if metrics is not None:
+                metrics.reset()
+            failed = None
+            try:
+                with span("watch_cycle") as counts:
+                    if cycle > 1 and coinbasepro_file is not None:
+                        update_coinbasepro_usd(coinbasepro_file, prices["USD"])
+                    for config in configs:
+                        config["watchCycle"] = cycle
+                        config["datetime"] = strftime("%Y-%m-%d %H-%M", localtime(time()))
+                    failed = run_cycle(configs)
+                    counts["failed"] = len(failed)
+            except Exception as e:
+                print("Watch cycle", cycle, "failed:", repr(e))
+            save_metrics(configs, failed)
+            sys.stdout.flush()
+
+            # Sleep until the next cycle, keeping idle sessions alive
+            while True:
+                remaining = interval - (monotonic() - started)
+                if remaining <= 0:
+                    break
+                sleep(min(remaining, float(configs[0]["sessionKeepAlive"])))
+                keep_sessions_warm(configs)
+    except KeyboardInterrupt:
+        print("")
+        print("Stopped watching.")
+
+
+def find_config_files(args):
+    # Multi-account configs as [(file_number, file_name)], from (in order of
+    # preference) --manifest=<file listing configs>, --config=1,2,15 (or the
+    # older --config=123 form) or the --configGlob=config*.csv pattern
+    if "manifest" in args:
+        with open(args["manifest"], mode='r') as file:
+            names = [line.strip() for line in file]
+        names = [name for name in names if name != "" and name[0] != '#']
+    elif "config" in args:
+        if ',' in args["config"]:
+            numbers = args["config"].split(',')
+        else:
+            numbers = list(args["config"])
+        names = ["config"+number.strip()+".csv" for number in numbers]
+    else:
+        names = glob(args.get("configGlob", "config*.csv"))
+        names.sort(key=lambda name: (len(name), name))
+
+    config_files = []
+    for name in names:
+        file_number = splitext(basename(name))[0]
+        if file_number[0:6] == "config":
+            file_number = file_number[6:]
+        if file_number != "" and exists(name):
+            config_files.append((file_number, name))
+    return config_files
+
+
+class ThreadOutput:
+    # sys.stdout stand-in that sends the prints of each worker thread (or
+    # asyncio task) to its own buffer so accounts fetched in parallel still
+    # print in config order
+    def __init__(self, stream):
+        self.stream = stream
+        self.buffer = ContextVar("buffer", default=None)
+
+    def write(self, text):
+        buffer = self.buffer.get()
+        if buffer is None:
+            return self.stream.write(text)
+        return buffer.write(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def fetch_transactions(config):
+    with span("fetch", config) as counts:
+        if "replay" in config:
+            html = load_snapshot(config, config["replay"])
+        elif config["cache"] == True and exists(config["cacheFile"]):
             with open(config["cacheFile"], "r") as htmlFile:
-                process_transactions(config, htmlFile)
+                html = htmlFile.read()
+        elif config["fetchEngine"] == "async":
+            html = load_transactions_async_run(config)
         else:
             html = load_transactions(config)
-            process_transactions(config, html)
+        counts["bytes"] = len(html)
+    return html
+
+
+def fetch_account(output, config):
+    output.buffer.set(StringIO())
+    try:
+        html = fetch_transactions(config)
+        error = None
+    except Exception as e:
+        html = None
+        error = e
+    finally:
+        buffered = output.buffer.get().getvalue()
+        output.buffer.set(None)
+    return html, error, buffered
+
+
+async def fetch_account_async(output, config, connector):
+    # fetch_account() for the async engine; each task has its own buffer
+    output.buffer.set(StringIO())
+    try:
+        with span("fetch", config) as counts:
+            if "replay" in config:
+                html = load_snapshot(config, config["replay"])
+            elif config["cache"] == True and exists(config["cacheFile"]):
+                with open(config["cacheFile"], "r") as htmlFile:
+                    html = htmlFile.read()
+            else:
+                html = await load_transactions_async(config, connector)
+            counts["bytes"] = len(html)
+        error = None
+    except Exception as e:
+        html = None
+        error = e
+    finally:
+        buffered = output.buffer.get().getvalue()
+    return html, error, buffered
+
+
+def fetch_accounts_async(output, configs):
+    # Every fetchEngine "async" account on one event loop, sharing a
+    # keep-alive connection pool
+    load_async_engine()
+
+    async def run():
+        connector = new_connector()
+        try:
+            return await asyncio.gather(*[fetch_account_async(output, config, connector) for config in configs])
+        finally:
+            await connector.close()
+    return asyncio.run(run())
+
+
+def run_accounts(configs):
+    # Fetch accounts concurrently (--workers=, default 4), each with its own
+    # twill browser, then process them one at a time in config order.
+    # Interactive accounts need the terminal so they run one by one.
+    workers = int(args.get("workers", 4))
+    if workers < 1 or any(config["interactive"] for config in configs):
+        workers = 1
+
+    failed = []
+    output = ThreadOutput(sys.stdout)
+    sys.stdout = output
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            # Async engine accounts all run on one event loop in one worker
+            async_configs = []
+            if workers > 1:
+                async_configs = [config for config in configs if config["fetchEngine"] == "async"]
+            async_future = None
+            if async_configs:
+                async_future = pool.submit(fetch_accounts_async, output, async_configs)
+
+            futures = []
+            for config in configs:
+                if workers == 1:
+                    futures.append(None)
+                elif config in async_configs:
+                    futures.append(async_future)
+                else:
+                    futures.append(pool.submit(fetch_account, output, config))
+
+            for config, future in zip(configs, futures):
+                if not config["silentMode"]:
+                    print("Config file", config["configFile"], "loaded...")
+
+                if future is None:
+                    try:
+                        html, error, buffered = fetch_transactions(config), None, ""
+                    except Exception as e:
+                        html, error, buffered = None, e, ""
+                elif future is async_future:
+                    try:
+                        html, error, buffered = future.result()[async_configs.index(config)]
+                    except Exception as e:
+                        html, error, buffered = None, e, ""
+                else:
+                    html, error, buffered = future.result()
+                output.stream.write(buffered)
+
+                if error is None:
+                    try:
+                        process_transactions(config, html)
+                    except Exception as e:
+                        error = e
+
+                if error is not None:
+                    failed.append(config["configFile"])
+                    print("Account", config["configFile"], "failed:", repr(error))
+                    print("")
+    finally:
+        sys.stdout = output.stream
+
+    if len(failed) > 0:
+        print(len(failed), "of", len(configs), "accounts failed:", ", ".join(failed))
+    return failed
 
 
 def get_epoch_from_utc(timestamp_string):
@@ -149,29 +1174,160 @@ def get_epoch_from_utc(timestamp_string):
 
 
 def convert_timezones(timestamp_string, timezone_src, timezone_dest):
-    local_tz = pytz_timezone(timezone_src)
-    dest_tz = pytz_timezone(timezone_dest)
+    local_tz = get_pytz_zone(timezone_src)
+    dest_tz = get_pytz_zone(timezone_dest)
     ts = datetime.strptime(timestamp_string, '%Y-%m-%d %H:%M:%S')
     ts = local_tz.localize(ts)
     tz_dest = ts.astimezone(dest_tz)
     ts_dest = str(tz_dest)
     ts_dest = ts_dest[0:19]+" "+tz_dest.tzname()+ts_dest[19:]
     
-    UTC_tz = pytz_timezone("UTC")
+    UTC_tz = get_pytz_zone("UTC")
     epoch = get_epoch_from_utc(str(ts.astimezone(UTC_tz))[0:19])
     
     return ts_dest, epoch
 
 
+pytz_zones = {}
+
+
+def get_pytz_zone(name):
+    if name not in pytz_zones:
+        load_pytz()
+        pytz_zones[name] = pytz_timezone(name)
+    return pytz_zones[name]
+
+
+tzset_lock = Lock()
+timezone_converters = {}
+
+
+def get_timezone_converter(timezone):
+    if timezone not in timezone_converters:
+        timezone_converters[timezone] = TimezoneConverter(timezone)
+    return timezone_converters[timezone]
+
+
+class TimezoneConverter:
+    # Wallet dates (always in default_timezone) to epochs and display strings
+    # in `timezone`.  Zones are resolved once per run and both directions are
+    # memoized, as many payouts share the same minute.  Output matches the
+    # old TZ/tzset() strings without touching the process environment; only
+    # platforms with neither zoneinfo nor pytz still fall back to tzset().
+    def __init__(self, timezone):
+        self.timezone = timezone
+        self.epochs = {}
+        self.times = {}
+        self.library = None
+        if not zoneinfoDisabledInternal:
+            try:
+                from zoneinfo import ZoneInfo
+                self.src = ZoneInfo(default_timezone)
+                self.dest = ZoneInfo(timezone)
+                self.library = "zoneinfo"
+            except Exception:
+                pass
+        if self.library is None and not pytzDisabledInternal:
+            self.src = get_pytz_zone(default_timezone)
+            self.dest = get_pytz_zone(timezone)
+            self.library = "pytz"
+
+    def epoch(self, date):
+        try:
+            return self.epochs[date]
+        except KeyError:
+            pass
+
+        if self.library == "zoneinfo":
+            ts = datetime.strptime(date, "%b %d, %Y %I:%M %p")
+            epoch = int(ts.replace(tzinfo=self.src).timestamp())
+        elif self.library == "pytz":
+            ts = datetime.strptime(date, "%b %d, %Y %I:%M %p")
+            # Same choice as mktime(): first of repeated, shifted forward in gaps
+            try:
+                ts = self.src.localize(ts, is_dst=None)
+            except AmbiguousTimeError:
+                ts = self.src.localize(ts, is_dst=True)
+            except NonExistentTimeError:
+                ts = self.src.localize(ts, is_dst=False)
+            epoch = int(ts.timestamp())
+        elif not tzsetDisabledInternal:
+            with tzset_lock:
+                environ['TZ'] = default_timezone
+                tzset()
+                epoch = int(mktime(strptime(date, "%b %d, %Y %I:%M %p")))
+        else:
+            epoch = int(mktime(strptime(date, "%b %d, %Y %I:%M %p")))
+
+        self.epochs[date] = epoch
+        return epoch
+
+    def display(self, epoch):
+        try:
+            return self.times[epoch]
+        except KeyError:
+            pass
+
+        if self.library is not None:
+            ts = datetime.fromtimestamp(epoch, self.dest)
+            if not tzsetDisabledInternal:
+                transaction_time = ts.strftime("%Y-%m-%d %H:%M %Z%z")
+            else:
+                # Format of the old pytz-only code path
+                transaction_time = str(ts)
+                transaction_time = transaction_time[0:19]+" "+ts.tzname()+transaction_time[19:]
+        elif not tzsetDisabledInternal:
+            with tzset_lock:
+                environ['TZ'] = self.timezone
+                tzset()
+                transaction_time = strftime("%Y-%m-%d %H:%M %Z%z", localtime(epoch))
+        else:
+            transaction_time = strftime("%Y-%m-%d %H:%M", localtime(epoch))
+
+        self.times[epoch] = transaction_time
+        return transaction_time
+
+    def convert(self, date):
+        epoch = self.epoch(date)
+        return self.display(epoch), epoch
+
+    def period(self, epoch, unit):
+        # (start, end) epochs of the day or month holding epoch, in this
+        # timezone (UTC without a zone library); end is exclusive
+        zone = self.dest if self.library is not None else None
+        if zone is None:
+            ts = datetime.utcfromtimestamp(epoch)
+        else:
+            ts = datetime.fromtimestamp(epoch, zone).replace(tzinfo=None)
+        start = ts.replace(hour=0, minute=0, second=0, microsecond=0)
+        if unit == "month":
+            start = start.replace(day=1)
+            end = (start + timedelta(days=32)).replace(day=1)
+        else:
+            end = start + timedelta(days=1)
+        return self.local_epoch(start), self.local_epoch(end)
+
+    def local_epoch(self, ts):
+        if self.library is None:
+            return get_epoch_from_utc(ts.isoformat(" "))
+        if self.library == "pytz":
+            return int(self.dest.localize(ts).timestamp())
+        return int(ts.replace(tzinfo=self.dest).timestamp())
+
+    def convert_many(self, dates):
+        return [self.convert(date) for date in dates]
+
+
 def process_command_arguments():
     cl_config = {}
+    commands = []
     for arg in argv:
         if len(arg) > 1 and arg[0:2] == "--":
             lines = arg[2:].split('=', 1)
             if len(lines) < 2:
                 assert False, f"Argument '{arg}' not valid!"
 
-            if tzsetDisabledInternal and pytzDisabledInternal and lines[0] == "timezone":
+            if tzsetDisabledInternal and pytzDisabledInternal and zoneinfoDisabledInternal and lines[0] == "timezone":
                 print("This platform does not support time zone changing!")
                 assert False, "Install 'pytz' module to fix..."
 
@@ -183,11 +1339,30 @@ def process_command_arguments():
                 cl_config[lines[0]] = lines[1]
 
         elif len(arg) > 1 and arg[0] == "-":
-            if arg[1:] == "init-cbp":
-                bootstrap_coinbasepro_usd(file_name="coinbasepro.csv")
-                exit()
-            if arg[1:] == "exit":
-                exit()
+            commands.append(arg[1:])
+
+    # Commands run after all --options are known
+    for command in commands:
+        if command == "init-cbp":
+            bootstrap_coinbasepro_usd(file_name="coinbasepro.csv")
+            exit()
+        if command == "check-parser":
+            file_names = sorted(glob(cl_config.get("checkFiles", "*Transactions *.html")))
+            exit(0 if check_parsers(file_names) else 1)
+        if command == "query":
+            exit(query_rollup(cl_config))
+        if command == "gains":
+            exit(report_gains(cl_config))
+        if command == "snapshots":
+            exit(list_snapshots(cl_config))
+        if command == "batch":
+            exit(run_batch(cl_config))
+        if command == "gaps":
+            exit(list_price_gaps(cl_config))
+        if command == "repair-cbp":
+            exit(repair_price_gaps(cl_config))
+        if command == "exit":
+            exit()
 
     """
     for cla in cl_config:
@@ -204,99 +1379,429 @@ def process_command_arguments():
 
 
 def load_bitcoin_usd(file_name, bitcoin=bitcoin):
-    global bitcoin_loaded
     print(f"Loading '{file_name}'...")
-    with open(file_name, mode='r') as file:
-        bitcoin_csv = csvreader(file)
-        counter = -1
-        for line in bitcoin_csv:
-            if counter > 0:
-                bitcoin[line[0]] = line[1:]
-            counter += 1
-        bitcoin_loaded = True
+    with span("load_bitcoin_usd") as counts:
+        counts["rows"] = len(bitcoin.load_csv(file_name))
 
 
-def bootstrap_coinbasepro_usd(file_name="coinbasepro.csv"):
-    print(f"Initializing '{file_name}'...")
-    with open(file_name, "w") as f:
-        f.write(
-            "1609372800,2020-12-31 00:00:00,BTC/USD,28897.42,28934.56,28891.76,28934.56,10.46338356\n")
-    update_coinbasepro_usd(file_name)
+def bootstrap_coinbasepro_usd(file_name="coinbasepro.csv", client=None):
+    if exists(file_name) and exists(file_name+".checkpoint"):
+        print(f"Resuming '{file_name}'...")
+    else:
+        print(f"Initializing '{file_name}'...")
+        with open(file_name, "w") as f:
+            f.write(
+                "1609372800,2020-12-31 00:00:00,BTC/USD,28897.42,28934.56,28891.76,28934.56,10.46338356\n")
+    update_coinbasepro_usd(file_name, client=client)
 
 
 def load_coinbasepro_usd(file_name, bitcoin=bitcoin):
-    global bitcoin_loaded
+    # Only indexes the file; days are read when transactions are priced
     print(f"Loading '{file_name}'...")
-    with open(file_name, mode='r') as file:
-        bitcoin_csv = csvreader(file)
-        for line in bitcoin_csv:
-            bitcoin[line[0]] = line[1:]
-            last = line
-        bitcoin_loaded = True
-        return last
-
-
-def update_coinbasepro_usd(file_name="coinbasepro.csv", bitcoin=bitcoin):
-    last = load_coinbasepro_usd(file_name, bitcoin)
-
-    print(f"Updating '{file_name}'...", end='', flush=True)
-    start = datetime.fromisoformat(last[1]) + timedelta(seconds=60)
+    with span("load_coinbasepro_usd") as counts:
+        source = DayIndex(file_name)
+        bitcoin.add_source(source)
+        counts["days"] = len(source.days)
+    return source.last
+
+
+class TokenBucket:
+    # Allows `rate` requests per second on average with bursts of `burst`
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = monotonic()
+        self.lock = Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(self.capacity, self.tokens +
+                                  (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def fetch_coinbasepro_window(client, bucket, start, retries=3):
     end = start + timedelta(minutes=299)
-
-    try:
-        result = cbp_client.get_product_historic_rates(
-            "BTC-USD", start.isoformat(), end.isoformat())
-    except:
-        print()
-        print("Warning: Unable to download from Coinbase Pro", end="")
-        result = []
-
-    previous = []
-
-    while len(result) > 0:
-        sleep(0.34)
-        print(".", end='', flush=True)
-
-        start += timedelta(minutes=300)
-        end += timedelta(minutes=300)
-
-        previous = result
+    for attempt in range(retries + 1):
+        bucket.acquire()
         try:
-            result = cbp_client.get_product_historic_rates(
+            return client.get_product_historic_rates(
                 "BTC-USD", start.isoformat(), end.isoformat())
-        except:
-            print()
-            print("Warning: Disconnected from Coinbase Pro", end="")
-            result = []
+        except Exception:
+            if attempt == retries:
+                raise
+            sleep(2 ** attempt)
 
-        if len(result) == 0:
-            break
-
-        result = result + previous
 
-    result = previous
-    result.reverse()
-    print("loaded", len(result)-1, "records.")
-    #print("")
+def read_coinbasepro_checkpoint(file_name):
+    # "<resume epoch>,<csv size>" written after every finished window
+    try:
+        with open(file_name+".checkpoint", "r") as f:
+            epoch, offset = f.read().split(',')
+        return int(epoch), int(offset)
+    except (OSError, ValueError):
+        return None, None
+
+
+def write_coinbasepro_checkpoint(file_name, epoch, offset):
+    with open(file_name+".checkpoint.tmp", "w") as f:
+        f.write(f"{epoch},{offset}")
+    replace(file_name+".checkpoint.tmp", file_name+".checkpoint")
+
+
+def trim_coinbasepro_usd(file_name):
+    # Drops a window that was only partly written; returns the checkpoint
+    checkpoint, offset = read_coinbasepro_checkpoint(file_name)
+    if offset is not None and getsize(file_name) > offset:
+        with open(file_name, "r+") as f:
+            f.truncate(offset)
+    return checkpoint, offset
+
+
+def coinbasepro_candles(result):
+    # [(epoch, timestamp, candle)] of a window, oldest first
+    candles = []
+    for candle in result:
+        timestamp = candle["time"].isoformat().replace("T", " ")
+        candles.append((get_epoch_from_utc(timestamp), timestamp, candle))
+    candles.sort(key=lambda x: x[0])
+    return candles
+
+
+def coinbasepro_line(epoch, timestamp, candle):
+    return (str(epoch)+','+timestamp+','+'BTC/USD,'+str(float(candle["open"]))+','+str(float(candle["high"]))+','+str(
+        float(candle["low"]))+','+str(float(candle["close"]))+','+str(float(candle["volume"]))+"\n")
+
+
+def update_coinbasepro_usd(file_name="coinbasepro.csv", bitcoin=bitcoin, client=None,
+                           workers=4, rate=3.0, burst=6):
+    # Downloads the 300 minute windows between the end of file_name and now.
+    # Up to `workers` requests are in flight under a token bucket rate limit;
+    # finished windows are appended in order and checkpointed so an interrupted
+    # run resumes where it stopped.
+    if client is None:
+        client = get_cbp_client()
+
+    if any(source.file_name == file_name for source in bitcoin.sources):
+        # Already loaded (--watch), continue from the candles in memory
+        checkpoint, offset = read_coinbasepro_checkpoint(file_name)
+        last = bitcoin.last_epoch()
+    else:
+        checkpoint, offset = trim_coinbasepro_usd(file_name)
+        last = load_coinbasepro_usd(file_name, bitcoin)
+    update_span = span("update_coinbasepro_usd")
+    counts = update_span.start()
+    windows = 0
 
-    with open(file_name, 'a') as f:
-        for x in range(0, len(result)-1):
-            timestamp = result[x]["time"].isoformat().replace("T", " ")
-            epoch = get_epoch_from_utc(timestamp)
-            bitcoin[str(epoch)] = [timestamp, 'BTC/USD', str(float(result[x]["open"])), str(float(result[x]["high"])), str(
-                float(result[x]["low"])), str(float(result[x]["close"])), str(float(result[x]["volume"]))]
-            f.write(str(epoch)+','+timestamp+','+'BTC/USD,'+str(float(result[x]["open"]))+','+str(float(result[x]["high"]))+','+str(
-                float(result[x]["low"]))+','+str(float(result[x]["close"]))+','+str(float(result[x]["volume"]))+"\n")
+    print(f"Updating '{file_name}'...", end='', flush=True)
+    resume = last
+    if checkpoint is not None and checkpoint > resume:
+        resume = checkpoint
+    start = datetime.utcfromtimestamp(resume) + timedelta(seconds=60)
+    now = datetime.utcnow()
+
+    bucket = TokenBucket(rate, burst)
+    records = 0
+    with open(file_name, 'a') as f, ThreadPoolExecutor(max_workers=workers) as pool:
+        in_flight = deque()
+        while start <= now or len(in_flight) > 0:
+            while start <= now and len(in_flight) < workers * 2:
+                in_flight.append((start, pool.submit(
+                    fetch_coinbasepro_window, client, bucket, start)))
+                start += timedelta(minutes=300)
+
+            window_start, future = in_flight.popleft()
+            try:
+                result = future.result()
+            except Exception:
+                print()
+                print("Warning: Disconnected from Coinbase Pro", end="")
+                for window in in_flight:
+                    window[1].cancel()
+                break
+
+            for epoch, timestamp, candle in coinbasepro_candles(result):
+                if epoch <= last:
+                    continue
+                last = epoch
+                records += 1
+                bitcoin.append(epoch, float(candle["open"]), float(candle["high"]), float(
+                    candle["low"]), float(candle["close"]), float(candle["volume"]))
+                f.write(coinbasepro_line(epoch, timestamp, candle))
+            f.flush()
+
+            # Windows that ended well in the past are done even if empty; the
+            # checkpoint only moves forward, so empty recent windows (an
+            # outage) don't send the next run back over finished ones
+            window_end = window_start + timedelta(minutes=299)
+            if window_end < now - timedelta(minutes=10):
+                resume = max(resume, get_epoch_from_utc(window_end.isoformat(" ")))
+            write_coinbasepro_checkpoint(file_name, max(resume, last), f.tell())
+            windows += 1
+            print(".", end='', flush=True)
+
+    print("loaded", records, "records.")
+    counts.update(rows=records, windows=windows)
+    update_span.stop()
+
+
+def read_checked_gaps(file_name):
+    # Ranges a repair already asked Coinbase Pro for and got no candles
+    # (minutes without trades), one "first,last" per line in <file>.empty
+    if not exists(file_name+".empty"):
+        return []
+    with open(file_name+".empty", "r") as f:
+        return sorted(tuple(int(x) for x in line.split(',')) for line in f if ',' in line)
+
+
+def write_checked_gaps(file_name, checked):
+    with open(file_name+".empty.tmp", "w") as f:
+        for first, last in sorted(set(checked)):
+            f.write(f"{first},{last}\n")
+    replace(file_name+".empty.tmp", file_name+".empty")
+
+
+def price_gaps(store, checked=()):
+    # Every missing minute range between the first and last minute of the
+    # store, reading all of its lazy days; gaps already checked are dropped
+    last = store.last_epoch()
+    if last is None:
+        return []
+    store.require([(0, last)])
+    first = min(segment.epochs[0] for segment in store.segments)
+    gaps = store.gaps(first, last)
+    return [gap for gap in gaps if len(missing_minutes(checked, gap[0], gap[1])) > 0]
+
+
+def gap_transactions(config, gaps):
+    # Transactions in the account's ledger per gap: those whose FMV reads a
+    # minute of it (their own minute, or their day or month; see fmvMethod)
+    found = [0] * len(gaps)
+    if len(gaps) == 0 or not exists(config["ledgerFile"]):
+        return found
+    starts = [gap[0] for gap in gaps]
+    ledger = sqlite_connect(config["ledgerFile"])
+    for (epoch,) in ledger.execute("SELECT epoch FROM transactions"):
+        t0, t1 = fmv_range(config, epoch)
+        x = bisect_right(starts, t1) - 1
+        while x >= 0 and gaps[x][1] >= t0:
+            found[x] += 1
+            x -= 1
+    ledger.close()
+    return found
+
+
+def gap_windows(gaps, minutes=300):
+    # The fewest `minutes` long windows (their start epochs) covering gaps
+    starts = []
+    for t0, t1 in gaps:
+        if len(starts) and starts[-1] + 60 * (minutes - 1) >= t0:
+            t0 = starts[-1] + 60 * minutes
+        while t0 <= t1:
+            starts.append(t0)
+            t0 += 60 * minutes
+    return starts
+
+
+def gap_time(epoch):
+    return strftime("%Y-%m-%d %H:%M", datetime.utcfromtimestamp(epoch).timetuple())
+
+
+def account_gaps(cl_config):
+    # [(currency, file name, gaps, {gap: transactions})] of the accounts'
+    # price series, without downloading anything
+    global args
+    args = cl_config
+    load_configs()
+    series = {}
+    for config in configs:
+        currency = (config["currency"] or default_currency()).upper()
+        if currency not in series:
+            store = load_prices(currency, update=False)
+            if store is None:
+                print("No", currency, "price files")
+                series[currency] = None
+                continue
+            file_name = "coinbasepro.csv" if len(store.sources) else None
+            checked = read_checked_gaps(file_name) if file_name is not None else []
+            series[currency] = (file_name, price_gaps(store, checked), {})
+        if series[currency] is None:
+            continue
+        file_name, gaps, flagged = series[currency]
+        for gap, found in zip(gaps, gap_transactions(config, gaps)):
+            if found > 0:
+                flagged[gap] = flagged.get(gap, 0) + found
+    return [(currency,) + found for currency, found in series.items() if found is not None]
+
+
+def list_price_gaps(cl_config):
+    # -gaps: missing minutes in the price files, and the transactions they
+    # leave unpriced or priced from fewer minutes.  --allGaps=True lists all.
+    for currency, file_name, gaps, flagged in account_gaps(cl_config):
+        missing = sum((t1 - t0) // 60 + 1 for t0, t1 in gaps)
+        print(f"{currency} ({file_name or 'Bitstamp files'}): {len(gaps)} gaps, {missing} minutes missing, "
+              f"{len(flagged)} with transactions")
+        for gap in gaps:
+            if gap in flagged or args.get("allGaps") == True:
+                t0, t1 = gap
+                print(f"  {gap_time(t0)} to {gap_time(t1)} UTC  {(t1 - t0) // 60 + 1:>7} minutes  "
+                      f"{flagged.get(gap, 0):>5} transactions")
+        if len(flagged) > 0 and file_name is not None:
+            print("Run ./cac.py -repair-cbp to download them again.")
+        print("")
+    return 0
+
+
+def repair_price_gaps(cl_config, client=None, workers=4, rate=3.0, burst=6):
+    # -repair-cbp: downloads only the coinbasepro.csv gaps that transactions
+    # need (--allGaps=True for every gap), in as few 300 minute windows as
+    # cover them, and merges the candles into the file in order.  Gaps that
+    # Coinbase Pro has no candles for are recorded and not asked for again.
+    file_name = "coinbasepro.csv"
+    if not exists(file_name):
+        print(f"No '{file_name}', run ./cac.py -init-cbp first")
+        return 1
+    trim_coinbasepro_usd(file_name)
+    found = [found for found in account_gaps(cl_config) if found[1] == file_name]
+    if len(found) == 0:
+        return 0
+    currency, file_name, gaps, flagged = found[0]
+    if args.get("allGaps") != True:
+        gaps = [gap for gap in gaps if gap in flagged]
+    windows = gap_windows(gaps)
+    print(f"Repairing {len(gaps)} gaps in '{file_name}' with {len(windows)} requests...", end='', flush=True)
+    if len(windows) == 0:
+        print("done.")
+        return 0
+    if client is None:
+        client = get_cbp_client()
+
+    with span("repair_price_gaps") as counts:
+        bucket = TokenBucket(rate, burst)
+        starts = [gap[0] for gap in gaps]
+        rows = {}
+        failed = []
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [(start, pool.submit(fetch_coinbasepro_window, client, bucket,
+                                           datetime.utcfromtimestamp(start))) for start in windows]
+            for start, future in futures:
+                try:
+                    result = future.result()
+                except Exception:
+                    failed.append((start, start + 60 * 299))
+                    print("x", end='', flush=True)
+                    continue
+                for epoch, timestamp, candle in coinbasepro_candles(result):
+                    # Only minutes inside a gap; the rest are already in the file
+                    x = bisect_right(starts, epoch) - 1
+                    if x >= 0 and epoch <= gaps[x][1]:
+                        rows[epoch] = coinbasepro_line(epoch, timestamp, candle).encode()
+                print(".", end='', flush=True)
+
+        merge_coinbasepro_rows(file_name, sorted(rows.items()))
+        print("added", len(rows), "records.")
+        counts.update(windows=len(windows), rows=len(rows), failed=len(failed))
+
+    # Minutes still missing from windows that were answered have no trades
+    received = minute_runs(sorted(rows))
+    checked = read_checked_gaps(file_name)
+    for t0, t1 in gaps:
+        checked += missing_minutes(sorted(received + failed), t0, t1)
+    write_checked_gaps(file_name, checked)
+    if len(failed) > 0:
+        print(f"Warning: {len(failed)} Coinbase Pro requests failed, run ./cac.py -repair-cbp again")
+        return 1
+    return 0
+
+
+def merge_coinbasepro_rows(file_name, rows):
+    # Writes the sorted (epoch, line) rows into coinbasepro.csv in epoch
+    # order.  Days before the first row are copied unchanged, the file is
+    # replaced in one step, and the day index and checkpoint are updated.
+    if len(rows) == 0:
+        return 0
+    source = DayIndex(file_name)
+    x = bisect_left(source.days, rows[0][0] - rows[0][0] % 86400)
+    start = source.offsets[x] if x < len(source.offsets) else source.size
+    days, offsets = source.days[:x], source.offsets[:x]
+    checkpoint, checkpoint_offset = read_coinbasepro_checkpoint(file_name)
+
+    with open(file_name, "rb") as f, open(file_name+".tmp", "wb") as out:
+        remaining = start
+        while remaining > 0:
+            data = f.read(min(remaining, 1 << 20))
+            out.write(data)
+            remaining -= len(data)
+
+        def write(epoch, line):
+            if epoch is not None:
+                day = epoch - epoch % 86400
+                if len(days) == 0 or day > days[-1]:
+                    days.append(day)
+                    offsets.append(out.tell())
+            out.write(line)
+
+        pending = deque(rows)
+        offset = start
+        while offset < source.size:
+            line = f.readline()
+            offset += len(line)
+            epoch = line_epoch(line)
+            while len(pending) and epoch is not None and pending[0][0] < epoch:
+                write(*pending.popleft())
+            write(epoch, line)
+        while len(pending):
+            write(*pending.popleft())
+        indexed = out.tell()
+        out.write(f.read())  # an unfinished last line
+    replace(file_name+".tmp", file_name)
+
+    added = indexed - source.size
+    source.days, source.offsets, source.size = days, offsets, indexed
+    source.save_index(0)
+    if checkpoint_offset is not None:
+        write_coinbasepro_checkpoint(file_name, checkpoint, checkpoint_offset + added)
+    return added
 
 
 def set_defaults(config, file_number=""):
     
     config["cache"] = False
+    # Keep compressed transaction pages by content hash (in snapshotDir) and
+    # skip processing when the page matches the last one processed
+    config["snapshots"] = False
+    # gzip, or zstd (pip install zstandard)
+    config["snapshotCompression"] = "gzip"
+    # Snapshots to keep (0 keeps all)
+    config["snapshotKeep"] = 30
     
     config["pythonScriptName"] = basename(__file__).lower()
 
     config["timezone"] = default_timezone
 
+    # Fiat currency of the FMV: USD or EUR (default: USD if its price files
+    # exist, otherwise EUR)
+    config["currency"] = ""
+
+    # Transaction page parser: lxml (streaming) or bs4 (BeautifulSoup)
+    config["parser"] = "lxml"
+
+    # Wallet fetching: twill, or async (aiohttp, accounts share one event loop)
+    config["fetchEngine"] = "twill"
+
+    # Bitcoin price lookup: exact, prior or minute (nearest within 60s)
+    config["priceMatch"] = "exact"
+    # FMV: open, close, day_average, day_vwap or month_end
+    config["fmvMethod"] = "open"
+
     config["useragent"] = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/90.0.4430.85 Safari/537.36 Edg/90.0.818.46"
 
     config["file_number"] = file_number
@@ -309,11 +1814,7 @@ def set_defaults(config, file_number=""):
         config["baseURL"] = "https://wallet.cryptoatcost.com/"
         config["prefix"] = "cac"
 
-    config["loginURL"] = config["baseURL"]+"login"
-    config["auth_2faURL"] = config["baseURL"]+"auth"
-    config["walletURL"] = config["baseURL"]+"wallet"
-    # Added /btc but all transactions button doesn't work
-    config["transactionURL"] = config["baseURL"]+"transaction/btc"
+    set_urls(config)
 
     ltime = localtime(time())
     config["datetime"] = strftime("%Y-%m-%d %H-%M", ltime)
@@ -324,18 +1825,45 @@ def set_defaults(config, file_number=""):
     config["auth_2fa"] = ""
     config["run_mode"] = "Interactive"
 
+    # Login retries, with jittered exponential backoff between them (seconds)
+    config["loginRetries"] = 4
+    config["backoffBase"] = 2.0
+    config["backoffMax"] = 60.0
+    # Only submit 2FA codes with at least this many seconds left to run
+    config["totpMargin"] = 5
+    # --watch: reload the wallet of sessions idle for this many seconds
+    config["sessionKeepAlive"] = 300
+
     # Config
     config["useCookies"] = False
     config["saveHTML"] = False
     config["saveCSV"] = True
+    # Export formats (comma separated): csv, csv.gz, jsonl or sqlite
+    config["exportFormat"] = "csv"
     config["silentMode"] = False
     config["addDateTime"] = True
+    # Write run metrics: a Prometheus textfile and/or a JSON status file
+    config["metricsFile"] = ""
+    config["metricsJson"] = ""
+
+    # Keep transactions in a SQLite ledger and only process new ones
+    config["useLedger"] = True
+    # Write realized gains from the ledger, matching withdrawals to lots
+    # acquired (mined or deposited) by FIFO, LIFO or HIFO
+    config["gainsReport"] = False
+    config["lotMethod"] = "FIFO"
 
     config["populategooglesheet"] = False
     # The name of the Google Sheet to populate
     config["googleSheet"] = "CloudAtCost"
     # The name of the google worksheet tab inside the above Spreadsheet
 
+    # full: rewrite the worksheet every run, append: only add new rows
+    config["googleSheetSync"] = "full"
+    # Cells per Sheets API request and requests per second
+    config["googleSheetChunk"] = 20000
+    config["googleSheetRate"] = 1.0
+
     if file_number == "":
         config["googleWorksheet"] = "Sheet1"
     else:
@@ -346,10 +1874,14 @@ def set_defaults(config, file_number=""):
         config["configFile"] = config["prefix"]+"-config"+".csv"
         config["cookieFile"] = config["prefix"]+"-cookie"+".bin"
         config["cacheFile"]  = config["prefix"]+"-cache"+".bin"
+        config["ledgerFile"] = config["prefix"]+"-ledger"+".db"
+        config["snapshotDir"] = config["prefix"]+"-snapshots"
     else:
         config["configFile"] = "config"+file_number+".csv"
         config["cookieFile"] = "cookie"+file_number+".bin"
         config["cacheFile"]  = "cache"+file_number+".bin"
+        config["ledgerFile"] = "ledger"+file_number+".db"
+        config["snapshotDir"] = "snapshots"+file_number
 
     if config["addDateTime"]:
         config["summaryHtmlFile"] = "Summary "+config["datetime"]+".html"
@@ -392,7 +1924,7 @@ def load_config(config):
                     assert False, f"Config file {config['configFile']} corrupt!"
                 #lines[1].replace('“','')
 
-                if tzsetDisabledInternal and pytzDisabledInternal and lines[0] == "timezone":
+                if tzsetDisabledInternal and pytzDisabledInternal and zoneinfoDisabledInternal and lines[0] == "timezone":
                     print("This platform does not support time zone changing!")
                     assert False, "Install 'pytz' module to fix..."
 
@@ -424,6 +1956,7 @@ def load_config(config):
         if pyotpDisabledInternal:
             assert False, "Python 'pyotp' module not installed!"
         else:
+            load_pyotp()
             config["totp"] = TOTP(config["auth_2fa"])
 
     if "saveFilePrefix" in config:
@@ -444,140 +1977,1498 @@ def load_config(config):
         config["csvFile"] = config["file_number"] + " " + config["csvFile"]
 
 
-def load_transactions(config):
-    # Initialize Twill Browser
-    log.disabled = True
-    reset_browser()
-    browser.agent_string = config["useragent"]
-
-    # See if we can load cached cookies
-    if config["useCookies"]:
+# Live sessions by cookie file, reused by later fetches in the same process
+# (--watch) so a valid session skips the login and 2FA entirely
+sessions = {}
+sessions_lock = Lock()
+
+HTTP_ERRORS = {
+    500: "500: Internal Server Error!",
+    502: "502: Website down for maintence!",  # needs better verification via HTML
+    503: "503: Service Unavailable!",
+    504: "504: Gateway Timeout!",
+}
+
+
+class Session:
+    # A twill browser for one account, with cookies from the last run
+    def __init__(self, config):
+        load_twill()
+        log.disabled = True
+        self.browser = TwillBrowser()
+        self.browser.agent_string = config["useragent"]
+        self.used = None  # monotonic() of the last logged in page
+        self.totp_window = None  # last 2FA window submitted
+        if config["useCookies"]:
+            try:
+                self.browser.load_cookies(config["cookieFile"])
+            except:
+                pass
+
+    def idle(self):
+        if self.used is None:
+            return None
+        return monotonic() - self.used
+
+
+def get_session(config):
+    with sessions_lock:
+        session = sessions.get(config["cookieFile"])
+        if session is None or config["configModified"]:
+            session = Session(config)
+            sessions[config["cookieFile"]] = session
+        return session
+
+
+def keep_sessions_warm(configs):
+    # Long running use: reload the wallet of sessions idle for more than
+    # sessionKeepAlive seconds so the site doesn't expire them
+    for config in configs:
+        session = sessions.get(config["cookieFile"])
+        if session is None or session.idle() is None or session.idle() < float(config["sessionKeepAlive"]):
+            continue
         try:
-            load_cookies(config["cookieFile"])
-        except:
-            pass
-
-    # Do the login and possibly 2FA, if needed
-    #retries = -1
-    while browser.url != config["baseURL"] or browser.code != 200:
-        if browser.code in [200, None]:
-            retries = -1
-        retries += 1
-        # Check for retry failure...
-        if retries > 3 and (browser.url != config["baseURL"] or browser.code != 200):
-            assert False, "Retry max exceeded!"
-        elif not config["silentMode"] and retries > 0:
-            print(browser.url, "==>", browser.code)
-            print("Retrying...")
-
-        if browser.url == None:
-            if not config["silentMode"]:
-                print("Accessing", config["baseURL"])
-            go(config["baseURL"])
-        
-        if len(browser.url) >=39 and browser.url[0:39] == "https://wallet.cryptoatcost.com/support":
-            if not config["silentMode"]:
-                print("Dismissing Support Notice...")
-            go("https://wallet.cryptoatcost.com/wallet")
-            
-        if browser.code == 200 and browser.url == config["loginURL"]:
-            assert browser.forms != [], "Login Form Missing!"
-            if config["interactive"]:
-                config["username"] = getinput("Username: ")
-                config["password"] = getpassword("Password: ")
-            fv("login", "email",  config["username"])
-            fv("login", "password", config["password"])
-            if config["interactive"]:
-                #username = ""
-                config["password"] = ""
-            elif not config["silentMode"]:
-                print("Logging In...")
-            sleep(1)
-            submit("0")
-            if browser.code != 200 or browser.url == config["loginURL"]:
-                if not config["silentMode"]:
-                    print("Login Failed!")
-                if not config["interactive"]:
-                    if not config["silentMode"]:
-                        print("Retrying in 30 seconds...")
-                        sleep(30)
+            session.browser.go(config["walletURL"])
+        except Exception:
+            session.used = None
+            continue
+        if session.browser.code == 200 and session.browser.url == config["walletURL"]:
+            session.used = monotonic()
+        else:
+            session.used = None
+
+
+def backoff_delay(failures, config):
+    # Exponential backoff with jitter: between half and all of
+    # backoffBase * 2^(failures-1) seconds, at most backoffMax
+    delay = min(float(config["backoffMax"]), float(config["backoffBase"]) * 2 ** (failures - 1))
+    return delay / 2 + uniform(0, delay / 2)
+
+
+def totp_window(config, session):
+    # Submit codes from a window that has totpMargin seconds left and
+    # hasn't been used yet, instead of sleeping and hoping.  Returns the
+    # seconds to wait and the code to send after that.
+    totp = config["totp"]
+    now = time()
+    window = int(now // totp.interval)
+    remaining = totp.interval - now % totp.interval
+    delay = 0
+    if window == session.totp_window or remaining < float(config["totpMargin"]):
+        delay = remaining + 0.1
+        window += 1
+    session.totp_window = window
+    return delay, str(totp.at(window * totp.interval))
+
+
+def go_steps(config, browser, url):
+    # Goes to url, retrying server errors with backoff
+    yield "go", url
+    failures = 0
+    while browser.code in HTTP_ERRORS and failures < int(config["loginRetries"]):
+        failures += 1
+        yield "wait", backoff_delay(failures, config)
+        yield "go", url
+
+
+def set_urls(config):
+    config["loginURL"] = config["baseURL"]+"login"
+    config["auth_2faURL"] = config["baseURL"]+"auth"
+    config["walletURL"] = config["baseURL"]+"wallet"
+    # Added /btc but all transactions button doesn't work
+    config["transactionURL"] = config["baseURL"]+"transaction/btc"
 
-        if browser.code in [200, 422] and browser.url == config["auth_2faURL"]:
-            assert browser.forms != [], "2FA Form Missing!"
-            if config["interactive"]:
-                authCode = getinput("2FA Code: ")
-            else:
-                sleep(1)
-                authCode = str(config["totp"].now())
-            fv("authCheck", "authCode", authCode)
-            if config["interactive"]:
-                authCode = ""
-            elif not config["silentMode"]:
-                print("Generating 2FA Code...")
-            submit("0")
-
-            # check if code expired
-            if browser.code == 422:
-                if not config["silentMode"]:
-                    print("422: 2FA Failed!")
-                if not config["interactive"]:
-                    wait = [2, 30, 31, 31][retries]
-                    if not config["silentMode"]:
-                        print("Retrying in", wait, "seconds...")
-                    sleep(wait)
 
-        if browser.code == 404:
-            assert False, "404: Page Not Found!"
+def fetch_steps(config, browser, totp_state):
+    # The wallet fetch both engines share, as steps for run_steps() (twill)
+    # or run_steps_async() (aiohttp) to carry out:
+    #   ("go", url), ("submit", form name, {field: value}), ("wait", seconds)
+    # The page each step lands on is read from browser.url/.code/.html.
+    # totp_state keeps the last 2FA window used.  Returns the transaction page.
 
-        if browser.code == 500:
-            assert False, "500: Internal Server Error!"
+    # A baseURL from a config file or the command line (e.g. a local test
+    # server) moves the other URLs with it
+    if not config["loginURL"].startswith(config["baseURL"]):
+        set_urls(config)
 
-        # Needs better verification via HTML
-        if browser.code == 502:
-            assert False, "502: Website down for maintence!"
+    # One request tells if the session is still good: the transaction page,
+    # which redirects to the login page when it isn't
+    if not config["silentMode"]:
+        print("Checking Session...")
+    with span("transactions", config):
+        yield "go", config["transactionURL"]
+    logged_in = browser.code == 200 and browser.url == config["transactionURL"]
 
-        if browser.code == 504:
-            assert False, "504: Gateway Timeout!"
+    if not logged_in:
+        yield from login_steps(config, browser, totp_state)
 
     if config["saveHTML"]:
+        if logged_in:
+            transaction_html = browser.html
+            yield from go_steps(config, browser, config["baseURL"])
+            assert browser.code == 200, "Failed to Load Summary"
         if not config["silentMode"]:
             print("Saving HTML", config["summaryHtmlFile"])
-        save_html(config["summaryHtmlFile"])
+        save_html(browser.html, config["summaryHtmlFile"])
 
     # Load and save Wallet if saving HTML files
     if config["saveHTML"]:
         if not config["silentMode"]:
             print("Loading Wallet...")
     
-        go(config["walletURL"])
+        with span("wallet", config):
+            yield from go_steps(config, browser, config["walletURL"])
         assert browser.code == 200, "Failed to Load Wallet"
     
         if not config["silentMode"]:
             print("Saving HTML", config["walletHtmlFile"])
-        save_html(config["walletHtmlFile"])
-        
-    # Load Transactions
-    if not config["silentMode"]:
-        print("Loading Transactions...")
+        save_html(browser.html, config["walletHtmlFile"])
 
-    go(config["transactionURL"])
-    assert browser.code == 200, "Failed to Load Transactions"
+    # Load Transactions, unless the session check already did
+    if not logged_in:
+        if not config["silentMode"]:
+            print("Loading Transactions...")
+        with span("transactions", config):
+            yield from go_steps(config, browser, config["transactionURL"])
+        assert browser.code == 200, "Failed to Load Transactions"
+        transaction_html = browser.html
+    elif not config["saveHTML"]:
+        transaction_html = browser.html
 
     if config["saveHTML"]:
         if not config["silentMode"]:
             print("Saving HTML", config["transactionHtmlFile"])
-        save_html(config["transactionHtmlFile"])
+        save_html(transaction_html, config["transactionHtmlFile"])
 
     if exists(config["cacheFile"]):
-        unlink(config["cacheFile"])
-        save_html(config["cacheFile"])
+        save_html(transaction_html, config["cacheFile"])
 
     if not config["interactive"] or config["useCookies"]:
         if not config["silentMode"]:
             print("Saving Cookies...")
-        save_cookies(config["cookieFile"])
+        browser.save_cookies(config["cookieFile"])
+
+    return transaction_html
+
+
+def login_steps(config, browser, totp_state):
+    # Do the login and possibly 2FA, retrying server errors, rejected codes
+    # and unexpected pages with backoff, until the summary page loads.  Only
+    # getting past the login or 2FA step resets the failure count, so
+    # loginRetries always ends the loop.
+    with span("login", config) as attempts:
+        attempts.update(attempts=0, retries=0, totp_failures=0)
+        failures = 0
+        while browser.url != config["baseURL"] or browser.code != 200:
+            attempts["attempts"] += 1
+            # Check for retry failure...
+            if failures > int(config["loginRetries"]):
+                assert False, HTTP_ERRORS.get(browser.code, "Retry max exceeded!")
+            elif failures > 0:
+                attempts["retries"] += 1
+                if not config["silentMode"]:
+                    print(browser.url, "==>", browser.code)
+                if not config["interactive"] or browser.code in HTTP_ERRORS:
+                    delay = backoff_delay(failures, config)
+                    if not config["silentMode"]:
+                        print(f"Retrying in {delay:.1f} seconds...")
+                    yield "wait", delay
+                elif not config["silentMode"]:
+                    print("Retrying...")
+                if browser.code not in [200, 422] or browser.url not in [config["loginURL"], config["auth_2faURL"]]:
+                    # Start again from the summary page
+                    yield "go", config["baseURL"]
+
+            progress = False
+            if browser.url == None:
+                if not config["silentMode"]:
+                    print("Accessing", config["baseURL"])
+                yield "go", config["baseURL"]
+
+            if browser.url.startswith(config["baseURL"]+"support"):
+                if not config["silentMode"]:
+                    print("Dismissing Support Notice...")
+                yield "go", config["walletURL"]
+
+            if browser.code == 200 and browser.url == config["loginURL"]:
+                if config["interactive"]:
+                    config["username"] = input("Username: ")
+                    config["password"] = getpassword("Password: ")
+                elif not config["silentMode"]:
+                    print("Logging In...")
+                fields = {"email": config["username"], "password": config["password"]}
+                if config["interactive"]:
+                    config["password"] = ""
+                yield "submit", "login", fields
+                if browser.code != 200 or browser.url == config["loginURL"]:
+                    if not config["silentMode"]:
+                        print("Login Failed!")
+                    failures += 1
+                    continue
+                progress = True
+
+            if browser.code in [200, 422] and browser.url == config["auth_2faURL"]:
+                if config["interactive"]:
+                    authCode = input("2FA Code: ")
+                else:
+                    if not config["silentMode"]:
+                        print("Generating 2FA Code...")
+                    delay, authCode = totp_window(config, totp_state)
+                    if delay > 0:
+                        yield "wait", delay
+                yield "submit", "authCheck", {"authCode": authCode}
+
+                # check if code expired
+                if browser.code == 422:
+                    if not config["silentMode"]:
+                        print("422: 2FA Failed!")
+                    attempts["totp_failures"] += 1
+                    failures += 1
+                    continue
+                progress = browser.code == 200 and browser.url != config["auth_2faURL"]
+
+            if browser.code == 404:
+                assert False, "404: Page Not Found!"
+
+            failures = 0 if progress else failures + 1
+
+
+def run_steps(config, browser, steps):
+    # Carries out fetch_steps() on a twill browser
+    try:
+        while True:
+            try:
+                step = next(steps)
+            except StopIteration as done:
+                return done.value
+            if step[0] == "go":
+                browser.go(step[1])
+            elif step[0] == "submit":
+                for field, value in step[2].items():
+                    browser_fv(browser, step[1], field, value)
+                browser.submit("0")
+            else:
+                wait(step[1], config)
+    finally:
+        steps.close()
+
+
+def load_transactions(config):
+    session = get_session(config)
+    transaction_html = run_steps(config, session.browser, fetch_steps(config, session.browser, session))
+    session.used = monotonic()
+    return transaction_html
+
+
+class AsyncBrowser:
+    # The parts of twill's browser load_transactions() uses (go, submitting
+    # a form, .url/.code/.html and cookies) on an aiohttp session.  Browsers
+    # of several accounts can share one connector (connection pool).
+    def __init__(self, config, connector):
+        jar = aiohttp.CookieJar(unsafe=True)  # unsafe: allow IP address hosts
+        if config["useCookies"]:
+            try:
+                jar.load(config["cookieFile"])
+            except Exception:
+                pass  # missing, or saved by twill
+        self.client = aiohttp.ClientSession(connector=connector, connector_owner=False, cookie_jar=jar,
+                                            headers={"User-Agent": config["useragent"]})
+        self.url = None
+        self.code = None
+        self.html = ""
+        self.totp_window = None
+
+    async def request(self, method, url, data=None):
+        async with self.client.request(method, url, data=data) as response:
+            self.html = await response.text()
+            self.url = str(response.url)
+            self.code = response.status
+
+    async def go(self, url):
+        await self.request("GET", url)
+
+    async def submit(self, form_name, fields):
+        # Posts form_name of the current page with fields filled in, like
+        # twill's fv + submit
+        doc = html_fromstring(self.html, base_url=self.url)
+        doc.make_links_absolute(self.url)
+        forms = [form for form in doc.forms if form_name in [form.get("name"), form.get("id")]]
+        assert forms != [], "Form "+form_name+" not found!"
+        values = dict(forms[0].form_values())
+        for control in forms[0].inputs:
+            if control.get("type") == "submit" and control.name is not None:
+                values.setdefault(control.name, control.value or "")
+                break
+        values.update(fields)
+        method = (forms[0].method or "GET").upper()
+        await self.request(method, forms[0].action or self.url, values if method == "POST" else None)
+
+    def save_cookies(self, file_name):
+        self.client.cookie_jar.save(file_name)
+
+    async def close(self):
+        await self.client.close()
+
+
+def new_connector():
+    # Keep-alive pool shared by all accounts on an event loop
+    return aiohttp.TCPConnector(limit=int(args.get("workers", 4)) * 2, keepalive_timeout=30)
+
+
+def load_async_engine():
+    if aiohttpDisabledInternal:
+        assert False, "Python 'aiohttp' module not installed!"
+    load_aiohttp()
+    load_lxml()
+
+
+def load_transactions_async_run(config):
+    # One account through the async engine, on its own event loop
+    load_async_engine()
+
+    async def run():
+        connector = new_connector()
+        try:
+            return await load_transactions_async(config, connector)
+        finally:
+            await connector.close()
+    return asyncio.run(run())
+
+
+async def run_steps_async(config, browser, steps):
+    # Carries out fetch_steps() on an AsyncBrowser
+    try:
+        while True:
+            try:
+                step = next(steps)
+            except StopIteration as done:
+                return done.value
+            if step[0] == "go":
+                await browser.go(step[1])
+            elif step[0] == "submit":
+                await browser.submit(step[1], step[2])
+            else:
+                await asyncio.sleep(step[1])
+    finally:
+        steps.close()
+
+
+async def load_transactions_async(config, connector):
+    # load_transactions() on an AsyncBrowser
+    browser = AsyncBrowser(config, connector)
+    try:
+        return await run_steps_async(config, browser, fetch_steps(config, browser, browser))
+    finally:
+        await browser.close()
+
+
+def browser_fv(browser, form_name, field_name, value):
+    # twill's fv command, but for a private browser instead of the global one
+    form = browser.form(form_name)
+    assert form is not None, "Form "+form_name+" not found!"
+    control = browser.form_field(form, field_name)
+    browser.clicked(form, control)
+    twill_utils.set_form_control_value(control, value)
+
+
+def save_html(html, file_name):
+    with open(file_name, "w", encoding="utf-8") as f:
+        f.write(html)
+
+
+SNAPSHOT_EXTENSIONS = {"gzip": ".html.gz", "zstd": ".html.zst"}
+
+
+def read_snapshot_index(config):
+    # [(saved epoch, sha256, file name)], oldest first
+    entries = []
+    index_file = join(config["snapshotDir"], "index.csv")
+    if exists(index_file):
+        with open(index_file, "r", newline='') as f:
+            for line in csvreader(f):
+                if len(line) == 3:
+                    entries.append((int(line[0]), line[1], line[2]))
+    return entries
+
+
+def write_snapshot_index(config, entries):
+    index_file = join(config["snapshotDir"], "index.csv")
+    with open(index_file+".tmp", "w", newline='') as f:
+        csvwriter(f, lineterminator="\n").writerows(entries)
+    replace(index_file+".tmp", index_file)
+
+
+# Settings that change the outputs written for the same page
+SNAPSHOT_SETTINGS = ["timezone", "fmvMethod", "priceMatch", "currency", "miner", "year", "select",
+                     "exclude", "kind", "parser", "useLedger", "saveCSV", "exportFormat", "gainsReport",
+                     "lotMethod", "populategooglesheet", "googleSheet", "googleWorksheet", "googleSheetSync"]
 
-    return browser.html
+
+def snapshot_key(config, digest):
+    # "<page sha256>,<settings hash>"
+    settings = json.dumps([config.get(key) for key in SNAPSHOT_SETTINGS])
+    return digest + "," + sha256(settings.encode("utf-8")).hexdigest()[0:16]
+
+
+def processed_snapshot(config):
+    # The key of the last snapshot processed, see snapshot_key()
+    file_name = join(config["snapshotDir"], "processed")
+    if not exists(file_name):
+        return None
+    with open(file_name, "r") as f:
+        return f.read().strip()
+
+
+def mark_snapshot(config, digest):
+    # Records the snapshot whose outputs were written, and with which settings
+    file_name = join(config["snapshotDir"], "processed")
+    with open(file_name+".tmp", "w") as f:
+        f.write(snapshot_key(config, digest))
+    replace(file_name+".tmp", file_name)
+
+
+def save_snapshot(config, html):
+    # Stores the page under its sha256 (once per content) and drops the
+    # oldest snapshots beyond snapshotKeep.  Returns the hash.
+    compression = config["snapshotCompression"]
+    assert compression in SNAPSHOT_EXTENSIONS, f"Unknown snapshotCompression '{compression}'"
+    data = html.encode("utf-8")
+    digest = sha256(data).hexdigest()
+    makedirs(config["snapshotDir"], exist_ok=True)
+    entries = read_snapshot_index(config)
+    known = [entry[2] for entry in entries if entry[1] == digest]
+    if len(known) > 0:
+        file_name = known[0]
+    else:
+        file_name = digest + SNAPSHOT_EXTENSIONS[compression]
+        if compression == "zstd":
+            assert not zstdDisabledInternal, "Install 'zstandard' module for zstd snapshots..."
+            load_zstd()
+            data = zstandard.ZstdCompressor(level=10).compress(data)
+        else:
+            data = gzip_compress(data, 9)
+        path = join(config["snapshotDir"], file_name)
+        with open(path+".tmp", "wb") as f:
+            f.write(data)
+        replace(path+".tmp", path)
+    entries = [entry for entry in entries if entry[1] != digest] + [(int(time()), digest, file_name)]
+
+    keep = int(config["snapshotKeep"])
+    if keep > 0 and len(entries) > keep:
+        processed = (processed_snapshot(config) or "").split(",")[0]
+        removed = [entry for entry in entries[:-keep] if entry[1] != processed]
+        for entry in removed:
+            if exists(join(config["snapshotDir"], entry[2])):
+                unlink(join(config["snapshotDir"], entry[2]))
+        entries = [entry for entry in entries if entry not in removed]
+    write_snapshot_index(config, entries)
+    return digest
+
+
+def load_snapshot(config, prefix):
+    # --replay=<hash>: the stored page whose hash starts with prefix
+    found = [entry for entry in read_snapshot_index(config) if entry[1].startswith(prefix)]
+    assert len(found) > 0, f"No snapshot '{prefix}' in '{config['snapshotDir']}'"
+    assert len(found) == 1, f"Snapshot '{prefix}' is ambiguous"
+    with open(join(config["snapshotDir"], found[0][2]), "rb") as f:
+        data = f.read()
+    if found[0][2].endswith(SNAPSHOT_EXTENSIONS["zstd"]):
+        assert not zstdDisabledInternal, "Install 'zstandard' module for zstd snapshots..."
+        load_zstd()
+        data = zstandard.ZstdDecompressor().decompress(data)
+    else:
+        data = gzip_decompress(data)
+    assert sha256(data).hexdigest() == found[0][1], f"Snapshot '{found[0][2]}' is damaged"
+    return data.decode("utf-8")
+
+
+def list_snapshots(cl_config):
+    # -snapshots: the stored pages of each account, newest first
+    global args
+    args = cl_config
+    load_configs()
+    for config in configs:
+        print("Account", config["configFile"], "("+config["snapshotDir"]+")")
+        processed = (processed_snapshot(config) or "").split(",")[0]
+        for epoch, digest, file_name in reversed(read_snapshot_index(config)):
+            size = getsize(join(config["snapshotDir"], file_name))
+            mark = "  (processed)" if digest == processed else ""
+            print(f"{strftime('%Y-%m-%d %H:%M:%S', localtime(epoch))}  {digest[0:16]}  {size:>10}{mark}")
+        print("")
+    return 0
+
+
+SPACES_RE = re_compile('(\t| )+')
+NEWLINES_RE = re_compile('\n+')
+ZERO_RE = re_compile(' 0.')
+
+
+def link_transaction(text):
+    # Returns (type, miner_id, kind, date, amount, amount_type) for the text
+    # of a transaction link, or None for any other link
+    res = SPACES_RE.sub(' ', text)
+    res = NEWLINES_RE.sub('\n', res)
+    res = ZERO_RE.sub("0.", res)
+
+    res = res.strip()
+    res = res.splitlines()
+
+    if len(res) == 3:
+        date = res[1].split(" ")
+        if len(date) == 5:
+
+            # Line 1
+            miner_id = 0
+            line1 = res[0].split(" ")
+            transaction_type = line1[0]
+            if len(line1) == 3:
+                miner_id = int(line1[2][0:-1])
+
+            if transaction_type == "Withdraw":
+                kind = "withdraw"
+            elif len(line1) == 3:  # Miner Deposit
+                kind = "mined"
+            elif len(line1) == 2:  # BTC deposit
+                kind = "deposit"
+            else:
+                kind = "other"
+
+            # Line 3
+            line3 = res[2].split(" ")
+
+            return transaction_type, miner_id, kind, res[1], line3[0], line3[1]
+    return None
+
+
+def parse_transactions_bs4(html):
+    # Original full DOM parse, kept as a fallback and reference
+    load_bs4()
+    soup = BeautifulSoup(html, "lxml")
+
+    for link in soup.find_all("a"):
+        transaction = link_transaction(link.text)
+        if transaction is not None:
+            yield transaction
+
+
+def parse_transactions_lxml(html, chunk_size=65536):
+    # Feeds the page to lxml in chunks and only looks at <a> elements,
+    # discarding each one once read, so memory stays flat however long the
+    # page is
+    load_lxml()
+    parser = HTMLPullParser(events=("end",), tag="a")
+    if isinstance(html, str):
+        chunks = (html[x:x+chunk_size] for x in range(0, len(html), chunk_size))
+    else:
+        chunks = iter(lambda: html.read(chunk_size), "")
+
+    for chunk in chunks:
+        parser.feed(chunk)
+        for event, link in parser.read_events():
+            transaction = link_transaction("".join(link.itertext()))
+            link.clear(keep_tail=True)
+            while link.getprevious() is not None:
+                del link.getparent()[0]
+            if transaction is not None:
+                yield transaction
+    parser.close()
+    for event, link in parser.read_events():
+        transaction = link_transaction("".join(link.itertext()))
+        if transaction is not None:
+            yield transaction
+
+
+def parse_transactions(html, parser="lxml"):
+    # Yields (type, miner_id, kind, date, amount, amount_type), newest first
+    if parser == "bs4":
+        return parse_transactions_bs4(html)
+    elif parser == "lxml":
+        return parse_transactions_lxml(html)
+    assert False, f"Unknown parser '{parser}'"
+
+
+def check_parsers(file_names):
+    # Confirms the streaming parser matches the BeautifulSoup one on saved pages
+    matched = True
+    for file_name in file_names:
+        with open(file_name, mode='r') as file:
+            html = file.read()
+        expected = list(parse_transactions_bs4(html))
+        found = list(parse_transactions_lxml(html))
+        if expected == found:
+            print(f"{file_name}: OK ({len(found)} transactions)")
+            continue
+        matched = False
+        for x in range(max(len(expected), len(found))):
+            if x >= len(expected) or x >= len(found) or expected[x] != found[x]:
+                break
+        print(f"{file_name}: MISMATCH at transaction {x+1} "
+              f"({len(expected)} bs4, {len(found)} lxml)")
+    return matched
+
+
+def batch_init(config):
+    # Forked workers inherit the parent's prices (memory-mapped .bin files
+    # and the coinbasepro.csv index); spawned ones open the files again but
+    # never download
+    currency = (config["currency"] or default_currency()).upper()
+    if currency not in prices:
+        if currency == "USD" and coinbasepro_available():
+            prices[currency] = PriceStore()
+            load_coinbasepro_usd("coinbasepro.csv", prices[currency])
+        else:
+            load_prices(currency)
+
+
+def batch_page(config, file_name):
+    # Processes one saved page into <batchDir>/<page>.csv and its printed
+    # summary into <batchDir>/<page>.txt; returns the .CSV name or None
+    stem = splitext(basename(file_name))[0]
+    page_config = dict(config)
+    page_config.update(csvFile=join(config["batchDir"], stem+".csv"), useLedger=False, saveCSV=True,
+                       exportFormat="csv", silentMode=False, populategooglesheet=False,
+                       gainsReport=False, snapshots=False)
+    if exists(page_config["csvFile"]):
+        unlink(page_config["csvFile"])
+    with open(file_name, "r", encoding="utf-8") as f:
+        html = f.read()
+    output = StringIO()
+    with redirect_stdout(output):
+        process_transactions(page_config, html)
+    with open(join(config["batchDir"], stem+".txt"), "w", encoding="utf-8") as f:
+        f.write(output.getvalue())
+    return page_config["csvFile"] if exists(page_config["csvFile"]) else None
+
+
+def merge_batch(config, csv_files):
+    # One .CSV of every transaction found in the pages, each once (by epoch,
+    # type, miner and amount), renumbered oldest first and written newest first
+    rows = {}
+    header = None
+    for file_name in csv_files:
+        with open(file_name, "r", newline='') as f:
+            reader = csvreader(f, skipinitialspace=True)
+            header = next(reader)
+            for row in reader:
+                rows.setdefault((row[0], row[3], row[4], row[5]), row)
+    merged = sorted(rows.values(), key=lambda row: (int(row[0]), int(row[1])))
+    if header is None:
+        return 0
+    export = CsvExport(join(config["batchDir"], "Transactions.csv"), header=header)
+    for transaction_id, row in reversed(list(enumerate(merged, 1))):
+        export.write([row[0], transaction_id] + row[2:])
+    export.close()
+    return len(merged)
+
+
+def run_batch(cl_config):
+    # -batch: reprocesses saved transaction pages (--batchFiles, a folder or
+    # glob; default the account's saveHTML pages) with the current config in
+    # a process pool (--workers, default one per core)
+    global args
+    args = cl_config
+    load_configs()
+    workers = int(args.get("workers", cpu_count() or 1))
+    # fork shares the loaded prices with the workers
+    context = get_context("fork" if "fork" in get_all_start_methods() else None)
+    for config in configs:
+        pattern = config.get("batchFiles", config["transactionHtmlFile"].replace(config["datetime"], "*"))
+        if isdir(pattern):
+            pattern = join(pattern, "*.html")
+        file_names = sorted(glob(pattern))
+        config.setdefault("batchDir", "batch"+config["file_number"])
+        print("Account", config["configFile"]+":", len(file_names), "pages from", pattern)
+        if len(file_names) == 0:
+            continue
+        makedirs(config["batchDir"], exist_ok=True)
+        with span("batch", config) as counts:
+            use_currency(config)
+            batch_config = {key: value for key, value in config.items() if key != "totp"}
+            csv_files = []
+            with ProcessPoolExecutor(max_workers=max(1, workers), mp_context=context,
+                                     initializer=batch_init, initargs=(batch_config,)) as pool:
+                futures = [pool.submit(batch_page, batch_config, file_name) for file_name in file_names]
+                for file_name, future in zip(file_names, futures):
+                    try:
+                        csv_file = future.result()
+                    except Exception as e:
+                        print(" ", file_name, "failed:", repr(e))
+                        continue
+                    print(" ", file_name, "->", csv_file or "no transactions")
+                    if csv_file is not None:
+                        csv_files.append(csv_file)
+            counts["pages"] = len(file_names)
+            counts["rows"] = merged = merge_batch(config, csv_files)
+        print("Merged", merged, "transactions into", join(config["batchDir"], "Transactions.csv"))
+        print("")
+    return 0
+
+
+def wallet_time(config, date):
+    # Converts a wallet date string to (transaction_time, transaction_epoch)
+    return get_timezone_converter(config["timezone"]).convert(date)
+
+
+# Ledgers kept open between --watch cycles, by ledger file
+ledgers = {}
+
+
+def open_ledger(config):
+    # Per account transaction ledger, in memory when useLedger is False
+    if config["ledgerFile"] in ledgers:
+        return ledgers[config["ledgerFile"]]
+    if config["useLedger"]:
+        ledger = sqlite_connect(config["ledgerFile"])
+    else:
+        ledger = sqlite_connect(":memory:")
+    ledger.execute("""CREATE TABLE IF NOT EXISTS transactions (
+        epoch INTEGER NOT NULL,
+        type TEXT NOT NULL,
+        miner INTEGER NOT NULL,
+        amount TEXT NOT NULL,
+        currency TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        date TEXT NOT NULL,
+        transaction_id INTEGER NOT NULL,
+        time TEXT,
+        timezone TEXT,
+        fmv REAL,
+        fiat TEXT,
+        method TEXT,
+        PRIMARY KEY (epoch, type, miner, amount))""")
+    columns = [row[1] for row in ledger.execute("PRAGMA table_info(transactions)")]
+    if "method" not in columns:
+        ledger.execute("ALTER TABLE transactions ADD COLUMN method TEXT")
+    ledger.execute(
+        "CREATE INDEX IF NOT EXISTS transactions_id ON transactions (transaction_id)")
+    ledger.execute(
+        "CREATE INDEX IF NOT EXISTS transactions_date ON transactions (date)")
+    ledger.execute("""CREATE TABLE IF NOT EXISTS sheet_sync (
+        sheet TEXT NOT NULL,
+        worksheet TEXT NOT NULL,
+        transaction_id INTEGER NOT NULL,
+        PRIMARY KEY (sheet, worksheet))""")
+    open_rollup(ledger)
+    return ledger
+
+
+# Rollup periods, as prefixes of the local transaction time
+ROLLUP_PERIODS = {"year": 4, "month": 7, "day": 10}
+
+
+def rollup_add(deltas, miner, time, kind, btc, fiat, count):
+    # Adds one transaction's change to its day in deltas
+    total = deltas.setdefault((miner, time[0:10], kind), [0.0, 0.0, 0])
+    total[0] += btc
+    total[1] += fiat
+    total[2] += count
+
+
+def update_rollup(ledger, deltas):
+    # Writes day deltas to the day, month and year totals
+    totals = {}
+    for (miner, day, kind), (btc, fiat, count) in deltas.items():
+        for length in ROLLUP_PERIODS.values():
+            total = totals.setdefault((miner, day[0:length], kind), [0.0, 0.0, 0])
+            total[0] += btc
+            total[1] += fiat
+            total[2] += count
+    ledger.executemany("INSERT OR IGNORE INTO rollup VALUES (?, ?, ?, 0.0, 0.0, 0)", totals.keys())
+    ledger.executemany("UPDATE rollup SET btc = btc + ?, fiat = fiat + ?, count = count + ? WHERE miner = ? AND period = ? AND kind = ?",
+                       [tuple(total) + key for key, total in totals.items()])
+
+
+def open_rollup(ledger):
+    # Per miner BTC and fiat totals by day, month and year for each kind
+    # (mined, deposit, withdraw), kept up to date by ingest_transactions()
+    new = ledger.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='rollup'").fetchone() is None
+    ledger.execute("""CREATE TABLE IF NOT EXISTS rollup (
+        miner INTEGER NOT NULL,
+        period TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        btc REAL NOT NULL,
+        fiat REAL NOT NULL,
+        count INTEGER NOT NULL,
+        PRIMARY KEY (miner, period, kind))""")
+    if new:
+        # Ledgers from before the rollup
+        for length in ROLLUP_PERIODS.values():
+            ledger.execute(f"""INSERT INTO rollup
+                SELECT miner, substr(time, 1, {length}), kind, SUM(CAST(amount AS REAL)),
+                       SUM(CAST(amount AS REAL) * COALESCE(fmv, 0.0)), COUNT(*)
+                FROM transactions WHERE time IS NOT NULL GROUP BY 1, 2, 3""")
+        ledger.commit()
+
+
+def query_rollup(cl_config):
+    # -query: per miner totals from the ledgers' rollups, no login or parse.
+    #   --by=day|month|year (default month), --miner=1234,5678,
+    #   --year=2022, --select=2022-03,2022-04 and --kind=mined|deposit|withdraw
+    global args
+    args = cl_config
+    load_configs()
+    by = args.get("by", "month")
+    assert by in ROLLUP_PERIODS, "--by must be day, month or year"
+
+    for config in configs:
+        if not exists(config["ledgerFile"]):
+            print("No ledger for", config["configFile"], "("+config["ledgerFile"]+")")
+            continue
+        ledger = sqlite_connect(config["ledgerFile"])
+        open_rollup(ledger)
+        sql = "SELECT miner, period, kind, btc, fiat, count FROM rollup WHERE count > 0 AND length(period) = ?"
+        values = [ROLLUP_PERIODS[by]]
+        if "miner" in config:
+            miners = config["miner"].split(',')
+            sql += " AND miner IN ("+", ".join("?" * len(miners))+")"
+            values += [int(miner) for miner in miners]
+        if "kind" in config:
+            sql += " AND kind = ?"
+            values.append(config["kind"])
+        for key in ["year", "select"]:
+            if key in config:
+                prefixes = config[key].split(',')
+                sql += " AND ("+" OR ".join(["substr(period, 1, ?) = ?"] * len(prefixes))+")"
+                for prefix in prefixes:
+                    values += [len(prefix), prefix]
+        fiat = ledger.execute("SELECT fiat FROM transactions WHERE fiat IS NOT NULL LIMIT 1").fetchone()
+        fiat = fiat[0] if fiat is not None else ""
+
+        print("Account", config["configFile"], "("+config["ledgerFile"]+")")
+        print(f"{'Miner ID':>8}  {'Period':10}  {'Type':8}  {'BTC':>14}  {'Fiat':>14}  {'Count':>6}")
+        for miner, period, kind, btc, fiat_total, count in ledger.execute(sql+" ORDER BY miner, period, kind", values):
+            print(f"{miner:>8}  {period:10}  {kind:8}  {btc:14.8f}  {fiat+format(fiat_total, '.2f'):>14}  {count:>6}")
+        print("")
+        ledger.close()
+    return 0
+
+
+def transaction_fmv(config, epoch):
+    # Fair market value by the account's fmvMethod:
+    #   open, close          - the transaction's minute (see priceMatch)
+    #   day_average          - mean minute close over the local day
+    #   day_vwap             - volume weighted price over the local day
+    #   month_end            - last close of the local month
+    method = config["fmvMethod"]
+    if method in ["open", "close"]:
+        return bitcoin.price(epoch, method, config["priceMatch"])
+
+    converter = get_timezone_converter(config["timezone"])
+    if method == "day_average":
+        t0, t1 = converter.period(epoch, "day")
+        return bitcoin.average(t0, t1 - 1)
+    if method == "day_vwap":
+        t0, t1 = converter.period(epoch, "day")
+        return bitcoin.vwap(t0, t1 - 1)
+    if method == "month_end":
+        t0, t1 = converter.period(epoch, "month")
+        return bitcoin.close(t0, t1 - 1)
+    assert False, f"Unknown fmvMethod '{method}'"
+
+
+def fmv_range(config, epoch):
+    # The span of minutes transaction_fmv() reads for epoch
+    method = config["fmvMethod"]
+    if method in ["open", "close"]:
+        return epoch, epoch
+    converter = get_timezone_converter(config["timezone"])
+    t0, t1 = converter.period(epoch, "month" if method == "month_end" else "day")
+    return t0, t1 - 1
+
+
+INGEST_BATCH = 500  # page rows looked up in the ledger per query
+
+
+def ingest_transactions(config, ledger, records, record_filter=None):
+    # Records arrive newest first.  Every row of the page is parsed and
+    # checked, since a transaction that completes late can show up below
+    # newer ones, so a run costs one pass over the page plus one indexed
+    # lookup per INGEST_BATCH rows (matched on their wallet fields), not a
+    # read of the whole ledger.  Only rows not already in the ledger are
+    # converted and priced.  Records the optional TransactionFilter rejects
+    # are skipped but keep their ids.
+    records = iter(records)
+    new = []
+    while True:
+        batch = list(islice(records, INGEST_BATCH))
+        if len(batch) == 0:
+            break
+        dates = list(set(record[3] for record in batch))
+        known = set(ledger.execute("SELECT date, type, miner, amount FROM transactions WHERE date IN (" +
+                                   ", ".join("?" * len(dates)) + ")", dates))
+        for transaction_type, miner_id, kind, date, amount, amount_type in batch:
+            if record_filter is not None and not record_filter.match_record(miner_id, kind, date):
+                record_filter.skipped += 1
+                new.append(None)
+                continue
+            if (date, transaction_type, miner_id, amount) in known:
+                continue
+            transaction_time, transaction_epoch = wallet_time(config, date)
+            new.append((transaction_epoch, transaction_type, miner_id, amount,
+                        amount_type, kind, date, transaction_time))
+
+    transaction_id = ledger.execute(
+        "SELECT COALESCE(MAX(transaction_id), 0) FROM transactions").fetchone()[0]
+    inserted = 0
+    deltas = {}  # rollup changes
+    for row in reversed(new):
+        if row is None:
+            transaction_id += 1
+            continue
+        transaction_epoch, transaction_type, miner_id, amount, amount_type, kind, date, transaction_time = row
+        cursor = ledger.execute("INSERT OR IGNORE INTO transactions VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                                (transaction_epoch, transaction_type, miner_id, amount, amount_type, kind, date,
+                                 transaction_id+1, transaction_time, config["timezone"], None, None, None))
+        if cursor.rowcount == 1:
+            transaction_id += 1
+            inserted += 1
+            rollup_add(deltas, miner_id, transaction_time, kind, float(amount), 0.0, 1)
+
+    # Refresh rows written under another timezone or without a price
+    stale = ledger.execute("SELECT rowid, date, time, miner, kind, amount, fmv FROM transactions WHERE timezone IS NOT ?",
+                           (config["timezone"],)).fetchall()
+    converted = get_timezone_converter(config["timezone"]).convert_many(
+        [row[1] for row in stale])
+    for (rowid, date, old_time, miner_id, kind, amount, fmv), (transaction_time, transaction_epoch) in zip(stale, converted):
+        ledger.execute("UPDATE transactions SET time=?, timezone=? WHERE rowid=?",
+                       (transaction_time, config["timezone"], rowid))
+        fiat = float(amount) * (fmv or 0.0)
+        if old_time is not None:
+            rollup_add(deltas, miner_id, old_time, kind, -float(amount), -fiat, -1)
+        rollup_add(deltas, miner_id, transaction_time, kind, float(amount), fiat, 1)
+
+    if bitcoin_loaded:
+        method = config["fmvMethod"]+":"+config["priceMatch"]
+        sql = "SELECT rowid, epoch, time, miner, kind, amount, fmv FROM transactions WHERE fmv IS NULL OR fiat IS NOT ? OR method IS NOT ?"
+        values = [bitcoin_currancy, method]
+        if config["fmvMethod"] not in ["open", "close"] and bitcoin.last_epoch() is not None:
+            # Day and month prices of the latest rows can still change
+            sql += " OR epoch > ?"
+            values.append(bitcoin.last_epoch() - 32 * 86400)
+        pending = ledger.execute(sql, values).fetchall()
+        bitcoin.require([fmv_range(config, row[1]) for row in pending])
+        price_span = span("price", config)
+        counts = price_span.start()
+        counts.update(hits=0, misses=0)
+        for rowid, transaction_epoch, transaction_time, miner_id, kind, amount, fmv in pending:
+            price = transaction_fmv(config, transaction_epoch)
+            counts["hits" if price is not None else "misses"] += 1
+            if price is not None:
+                cursor = ledger.execute("UPDATE transactions SET fmv=?, fiat=?, method=? WHERE rowid=? AND (fmv IS NOT ? OR fiat IS NOT ? OR method IS NOT ?)",
+                                        (price, bitcoin_currancy, method, rowid, price, bitcoin_currancy, method))
+                if cursor.rowcount == 1 and price != fmv:
+                    rollup_add(deltas, miner_id, transaction_time, kind, 0.0, float(amount) * (price - (fmv or 0.0)), 0)
+        price_span.stop()
+
+    update_rollup(ledger, deltas)
+
+    ledger.commit()
+    return inserted
+
+
+CSV_HEADER = ["Epoch", "Transaction", "Date", "Type", "Miner ID", "Amount", "Currency", "FMV", "Bitcoin"]
+EXPORT_FIELDS = ["epoch", "transaction_id", "date", "type", "miner_id", "amount", "currency", "fmv", "bitcoin"]
+EXPORT_FORMATS = {"csv": ".csv", "csv.gz": ".csv.gz", "jsonl": ".jsonl", "sqlite": ".sqlite"}
+
+
+class Export:
+    # Writes transactions one at a time to a temporary file that replaces
+    # the export file on close(), or is removed by discard() when nothing
+    # was selected so an earlier export is left alone
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.temp_name = file_name+".tmp"
+        self.rows = 0
+
+    def write(self, transaction):
+        self.rows += 1
+
+    def close(self):
+        replace(self.temp_name, self.file_name)
+
+    def discard(self):
+        if exists(self.temp_name):
+            unlink(self.temp_name)
+
+
+class CsvExport(Export):
+    # Same layout as always ("a, b, c"), but fields containing commas,
+    # quotes or newlines are quoted by the csv module.  Read it back with
+    # skipinitialspace=True.
+    def __init__(self, file_name, compress=False, header=None):
+        Export.__init__(self, file_name)
+        if compress:
+            self.file = gzip_open(self.temp_name, 'wt', newline='')
+        else:
+            self.file = open(self.temp_name, 'w', newline='')
+        self.writer = csvwriter(self.file, lineterminator="\n")
+        if header is None:
+            header = CSV_HEADER if bitcoin_loaded else CSV_HEADER[0:7]
+        self.file.write(", ".join(header)+"\n")
+
+    def write(self, transaction):
+        Export.write(self, transaction)
+        self.writer.writerow([transaction[0]] + [" "+str(value) for value in transaction[1:]])
+
+    def close(self):
+        self.file.close()
+        Export.close(self)
+
+    def discard(self):
+        self.file.close()
+        Export.discard(self)
+
+
+class JsonlExport(Export):
+    def __init__(self, file_name):
+        Export.__init__(self, file_name)
+        self.file = open(self.temp_name, 'w')
+
+    def write(self, transaction):
+        Export.write(self, transaction)
+        self.file.write(json.dumps(dict(zip(EXPORT_FIELDS, transaction)))+"\n")
+
+    def close(self):
+        self.file.close()
+        Export.close(self)
+
+    def discard(self):
+        self.file.close()
+        Export.discard(self)
+
+
+class SqliteExport(Export):
+    def __init__(self, file_name):
+        Export.__init__(self, file_name)
+        Export.discard(self)  # left over from an interrupted run
+        self.db = sqlite_connect(self.temp_name)
+        self.columns = EXPORT_FIELDS if bitcoin_loaded else EXPORT_FIELDS[0:7]
+        self.db.execute(f"CREATE TABLE transactions ({', '.join(self.columns)})")
+        self.insert = f"INSERT INTO transactions VALUES ({', '.join('?' * len(self.columns))})"
+
+    def write(self, transaction):
+        Export.write(self, transaction)
+        self.db.execute(self.insert, transaction)
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+        Export.close(self)
+
+    def discard(self):
+        self.db.close()
+        Export.discard(self)
+
+
+def export_file_name(config, export_format):
+    # csvFile with the format's extension, e.g. Transactions.jsonl
+    if export_format == "csv":
+        return config["csvFile"]
+    stem = config["csvFile"]
+    if stem.lower().endswith(".csv"):
+        stem = stem[:-4]
+    return stem + EXPORT_FORMATS[export_format]
+
+
+def open_exports(config):
+    export_formats = [export_format.strip() for export_format in config["exportFormat"].split(',')]
+    for export_format in export_formats:
+        if export_format not in EXPORT_FORMATS:
+            assert False, f"Unknown exportFormat '{export_format}'"
+
+    exports = []
+    for export_format in export_formats:
+        file_name = export_file_name(config, export_format)
+        if export_format == "csv":
+            exports.append(CsvExport(file_name))
+        elif export_format == "csv.gz":
+            exports.append(CsvExport(file_name, compress=True))
+        elif export_format == "jsonl":
+            exports.append(JsonlExport(file_name))
+        else:
+            exports.append(SqliteExport(file_name))
+    return exports
+
+
+LOT_METHODS = ["FIFO", "LIFO", "HIFO"]
+SATOSHI = 100000000
+GAINS_HEADER = ["Disposed", "Transaction", "Acquired", "Lot", "Kind", "Miner ID", "Amount",
+                "Proceeds", "Cost Basis", "Gain", "Term"]
+
+
+class LotPool:
+    # Open lots in flat arrays (epoch, ledger rowid, satoshis left, cost
+    # per BTC), about 40 bytes a lot.  The order lots are used in is a
+    # deque of lot numbers for FIFO/LIFO and a heap for HIFO, whose keys
+    # are single ints: highest cost in cents first, then the oldest lot.
+    def __init__(self, method):
+        assert method in LOT_METHODS, f"Unknown lotMethod '{method}'"
+        self.method = method
+        self.epochs = array('q')
+        self.rowids = array('q')
+        self.left = array('q')
+        self.costs = array('d')
+        self.order = [] if method == "HIFO" else deque()
+        self.satoshis = 0
+        self.basis = 0.0
+
+    def __len__(self):
+        return len(self.order)
+
+    def acquire(self, epoch, rowid, satoshis, cost):
+        lot = len(self.rowids)
+        self.epochs.append(epoch)
+        self.rowids.append(rowid)
+        self.left.append(satoshis)
+        self.costs.append(cost)
+        self.satoshis += satoshis
+        self.basis += satoshis * cost / SATOSHI
+        if self.method == "HIFO":
+            heappush(self.order, (-round(cost * 100) << 40) | lot)
+        else:
+            self.order.append(lot)
+
+    def next_lot(self):
+        if self.method == "HIFO":
+            return self.order[0] & ((1 << 40) - 1)
+        if self.method == "LIFO":
+            return self.order[-1]
+        return self.order[0]
+
+    def dispose(self, satoshis):
+        # Yields (lot, satoshis) taken from lots in order; lot is None for
+        # any part of satoshis that no lot covers
+        while satoshis > 0 and len(self.order) > 0:
+            lot = self.next_lot()
+            taken = min(satoshis, self.left[lot])
+            self.left[lot] -= taken
+            self.satoshis -= taken
+            self.basis -= taken * self.costs[lot] / SATOSHI
+            satoshis -= taken
+            if self.left[lot] == 0:
+                if self.method == "HIFO":
+                    heappop(self.order)
+                elif self.method == "LIFO":
+                    self.order.pop()
+                else:
+                    self.order.popleft()
+            yield lot, taken
+        if satoshis > 0:
+            yield None, satoshis
+
+
+def gains_file_name(config):
+    stem = config["csvFile"]
+    if stem.lower().endswith(".csv"):
+        stem = stem[:-4]
+    return stem + " Gains.csv"
+
+
+def write_gains(config, ledger):
+    # Streams realized gains to the gains .CSV, one row per lot (part) used
+    # by each withdrawal.  Returns (realized gain, open lots).
+    pool = LotPool(config["lotMethod"].upper())
+    export = CsvExport(gains_file_name(config), header=GAINS_HEADER)
+    realized = 0.0
+    try:
+        for rowid, transaction_id, epoch, transaction_time, kind, amount, fmv in ledger.execute(
+                "SELECT rowid, transaction_id, epoch, time, kind, amount, fmv FROM transactions ORDER BY epoch, transaction_id"):
+            satoshis = round(abs(float(amount)) * SATOSHI)
+            if kind in ["mined", "deposit"]:
+                pool.acquire(epoch, rowid, satoshis, fmv or 0.0)
+                continue
+            if kind != "withdraw":
+                continue
+            for lot, taken in pool.dispose(satoshis):
+                proceeds = taken * (fmv or 0.0) / SATOSHI
+                if lot is None:
+                    row = [transaction_time, transaction_id, "", "", "", "", taken / SATOSHI, proceeds, 0.0, proceeds, ""]
+                else:
+                    lot_id, acquired, lot_kind, lot_miner = ledger.execute(
+                        "SELECT transaction_id, time, kind, miner FROM transactions WHERE rowid=?",
+                        (pool.rowids[lot],)).fetchone()
+                    basis = taken * pool.costs[lot] / SATOSHI
+                    term = "long" if epoch - pool.epochs[lot] > 365 * 86400 else "short"
+                    row = [transaction_time, transaction_id, acquired, lot_id, lot_kind, lot_miner,
+                           taken / SATOSHI, proceeds, basis, proceeds - basis, term]
+                realized += row[9]
+                export.write([row[0]] + row[1:6] + [format(row[6], ".8f")] +
+                             [format(value, ".2f") for value in row[7:10]] + row[10:])
+    except BaseException:
+        export.discard()
+        raise
+    export.close()
+    return realized, pool
+
+
+def report_gains(cl_config):
+    # -gains: writes the gains .CSV of each account from its ledger, no login
+    global args
+    args = cl_config
+    load_configs()
+    for config in configs:
+        if not exists(config["ledgerFile"]):
+            print("No ledger for", config["configFile"], "("+config["ledgerFile"]+")")
+            continue
+        ledger = sqlite_connect(config["ledgerFile"])
+        print_gains(config, ledger)
+        ledger.close()
+    return 0
+
+
+def print_gains(config, ledger):
+    with span("gains", config) as counts:
+        realized, pool = write_gains(config, ledger)
+        counts["lots"] = len(pool.rowids)
+    fiat = ledger.execute("SELECT fiat FROM transactions WHERE fiat IS NOT NULL LIMIT 1").fetchone()
+    fiat = fiat[0] if fiat is not None else ""
+    if not config["silentMode"]:
+        print("Saving '"+gains_file_name(config)+"'")
+        print(f"Realized Gain ({pool.method}) = {fiat}{realized:.2f}")
+        print(f"Open Lots = {len(pool)}, {pool.satoshis / SATOSHI:.8f} BTC, cost basis {fiat}{pool.basis:.2f}")
+        print("")
+
+
+def write_csv(config, transactions):
+    export = CsvExport(config["csvFile"])
+    for transaction in transactions:
+        export.write(transaction)
+    export.close()
+
+
+SHEET_HEADER = ["Miner ID", "Epoch", "Transaction", "Amount", "Date", "Type", "Currency", "FMV", "Bitcoin"]
+
+
+def sheet_row(transaction):
+    row = [transaction[4], transaction[0], transaction[1], transaction[5],
+           transaction[2], transaction[3], transaction[6]]
+    if bitcoin_loaded:
+        row.append(transaction[7])
+        row.append(transaction[8])
+    return row
+
+
+def build_sheet_cells(config, transactions):
+    load_gspread()
+    # mark the time in the google sheet
+    cells = [Cell(row=1, col=1, value=config["datetime"])]
+
+    # header on row 2, transactions (newest first) from row 3
+    rows = [SHEET_HEADER if bitcoin_loaded else SHEET_HEADER[0:7]]
+    rows += [sheet_row(transaction) for transaction in transactions]
+    for row, values in enumerate(rows, 2):
+        for col, value in enumerate(values, 1):
+            cells.append(Cell(row=row, col=col, value=value))
+    return cells
+
+
+def open_google_worksheet(config):
+    # google sheets scope setup
+    scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/spreadsheets',
+             'https://www.googleapis.com/auth/drive.file', 'https://www.googleapis.com/auth/drive']
+
+    if not exists(config["googleCreds"]):
+        assert False, "Google service account credentials file not found (" + \
+            config["googleCreds"]+")"
+    load_gspread()
+    creds = service_account.Credentials.from_service_account_file(
+        config["googleCreds"], scopes=scope)
+    client = authorize(creds)
+    sheet = client.open(config["googleSheet"])  # the spreadhseet name
+    # the worksheet name (in the spreadsheet above)
+    return sheet.worksheet(config["googleWorksheet"])
+
+
+def sheet_bucket(config):
+    # Sheets allows 60 write requests a minute per user
+    return TokenBucket(float(config["googleSheetRate"]), 5)
+
+
+def push_google_sheet(config, cells, wksheet=None):
+    # Full rewrite, split into requests of at most googleSheetChunk cells
+    if wksheet is None:
+        wksheet = open_google_worksheet(config)
+    bucket = sheet_bucket(config)
+    size = int(config["googleSheetChunk"])
+    for x in range(0, len(cells), size):
+        bucket.acquire()
+        wksheet.update_cells(cells[x:x+size], value_input_option='USER_ENTERED')
+    return len(cells)
+
+
+def sheet_watermark(config, ledger, wksheet):
+    # Highest transaction id already in the sheet: stored in the ledger after
+    # each sync, otherwise read from the sheet's Transaction column
+    row = ledger.execute("SELECT transaction_id FROM sheet_sync WHERE sheet=? AND worksheet=?",
+                         (config["googleSheet"], config["googleWorksheet"])).fetchone()
+    if row is not None:
+        return row[0]
+    ids = [str(value) for value in wksheet.col_values(3)[2:]]
+    ids = [int(value) for value in ids if value.isdigit()]
+    if len(ids) == 0:
+        return None
+    return max(ids)
+
+
+def save_sheet_watermark(config, ledger, transaction_id):
+    ledger.execute("INSERT OR REPLACE INTO sheet_sync VALUES (?, ?, ?)",
+                   (config["googleSheet"], config["googleWorksheet"], transaction_id))
+    ledger.commit()
+
+
+def sync_google_sheet(config, transactions, wksheet=None):
+    # Returns the number of cells written.  googleSheetSync=append only adds
+    # rows newer than the sheet's watermark (inserted under the header, so
+    # the sheet stays newest first) and updates the timestamp; anything else,
+    # or a sheet that does not line up with the ledger, gets a full rewrite.
+    if wksheet is None:
+        wksheet = open_google_worksheet(config)
+    ledger = open_ledger(config)
+    newest = max(transaction[1] for transaction in transactions)
+
+    watermark = None
+    if config["googleSheetSync"] == "append":
+        watermark = sheet_watermark(config, ledger, wksheet)
+
+    if watermark is None or watermark > newest:
+        written = push_google_sheet(config, build_sheet_cells(config, transactions), wksheet)
+    else:
+        rows = [sheet_row(transaction) for transaction in transactions
+                if transaction[1] > watermark]
+        bucket = sheet_bucket(config)
+        bucket.acquire()
+        wksheet.update_acell("A1", config["datetime"])
+        written = 1
+
+        # Insert the oldest chunk first so the newest rows end up on top
+        size = max(1, int(config["googleSheetChunk"]) // len(SHEET_HEADER))
+        chunks = [rows[x:x+size] for x in range(0, len(rows), size)]
+        for chunk in reversed(chunks):
+            bucket.acquire()
+            wksheet.insert_rows(chunk, row=3, value_input_option='USER_ENTERED')
+            written += sum(len(row) for row in chunk)
+
+    save_sheet_watermark(config, ledger, newest)
+    if config["ledgerFile"] not in ledgers:
+        ledger.close()
+    return written
+
+
+WALLET_MONTHS = {"Jan": 1, "Feb": 2, "Mar": 3, "Apr": 4, "May": 5, "Jun": 6,
+                 "Jul": 7, "Aug": 8, "Sep": 9, "Oct": 10, "Nov": 11, "Dec": 12}
+
+
+def prefix_range(converter, prefix):
+    # Epochs [start, end) of the local times starting with prefix, widened
+    # to its year, month, day, hour or minute ("2022-03-1" -> March 2022);
+    # None when the prefix isn't a date
+    for length, unit in [(16, "minute"), (13, "hour"), (10, "day"), (7, "month"), (4, "year")]:
+        if len(prefix) >= length:
+            break
+    else:
+        return None
+    try:
+        start = datetime.strptime(prefix[0:length], "%Y-%m-%d %H:%M"[0:length - 2])
+    except ValueError:
+        return None
+    if unit == "year":
+        end = start.replace(year=start.year + 1)
+    elif unit == "month":
+        end = (start + timedelta(days=32)).replace(day=1)
+    else:
+        end = start + timedelta(**{unit+"s": 1})
+    return converter.local_epoch(start), converter.local_epoch(end)
+
+
+class TransactionFilter:
+    # The miner, kind, year, select and exclude options compiled once.
+    # match() is the exact test on the local transaction time; the year and
+    # select prefixes are also turned into epoch ranges (a day wider, for
+    # timezone and DST edges) so the ledger query, and without a ledger the
+    # raw wallet dates, can skip most other rows before any conversion.
+    def __init__(self, config):
+        self.miners = None
+        self.kinds = None
+        if "miner" in config:
+            self.miners = set(config["miner"].split(','))
+        if "kind" in config:
+            self.kinds = set(config["kind"].split(','))
+        self.year = config.get("year")
+        self.select = tuple(config["select"].split(',')) if "select" in config else None
+        self.exclude = config.get("exclude")
+        self.skipped = 0
+
+        converter = get_timezone_converter(config["timezone"])
+        self.ranges = []  # a row must be in one range of each list
+        for prefixes in [[self.year] if self.year is not None else None, self.select]:
+            if prefixes is None:
+                continue
+            ranges = [prefix_range(converter, prefix) for prefix in prefixes]
+            if None not in ranges:
+                self.ranges.append([(start - 86400, end + 86400) for start, end in ranges])
+
+        # Wallet date (year, month)s inside the ranges, for match_record()
+        self.months = []
+        for ranges in self.ranges:
+            months = set()
+            for start, end in ranges:
+                ts = datetime.utcfromtimestamp(start).replace(day=1)
+                while ts <= datetime.utcfromtimestamp(end):
+                    months.add((ts.year, ts.month))
+                    ts = (ts + timedelta(days=32)).replace(day=1)
+            self.months.append(months)
+
+    def active(self):
+        return self.miners is not None or self.kinds is not None or len(self.ranges) > 0
+
+    def match(self, miner_id, kind, transaction_time):
+        if self.miners is not None and str(miner_id) not in self.miners:
+            return False
+        if self.kinds is not None and kind not in self.kinds:
+            return False
+        if self.year is not None and transaction_time[0:4] != self.year:
+            return False
+        if self.select is not None and not transaction_time.startswith(self.select):
+            return False
+        if self.exclude is not None and transaction_time.startswith(self.exclude):
+            return False
+        return True
+
+    def match_record(self, miner_id, kind, date):
+        # Could the raw wallet record ("May 4, 2021 4:50 AM") match?  Only
+        # rejects rows that certainly don't.
+        if self.miners is not None and str(miner_id) not in self.miners:
+            return False
+        if self.kinds is not None and kind not in self.kinds:
+            return False
+        if len(self.months) > 0:
+            try:
+                month = (int(date[date.index(", ")+2:][0:4]), WALLET_MONTHS[date[0:3]])
+            except (ValueError, KeyError):
+                return True
+            for months in self.months:
+                if month not in months:
+                    return False
+        return True
+
+    def where(self):
+        # SQL condition and values for the ledger query
+        conditions = []
+        values = []
+        if self.miners is not None:
+            miners = [int(miner) for miner in self.miners if miner.isdigit()]
+            conditions.append("miner IN ("+", ".join("?" * len(miners))+")")
+            values += miners
+        if self.kinds is not None:
+            conditions.append("kind IN ("+", ".join("?" * len(self.kinds))+")")
+            values += sorted(self.kinds)
+        for ranges in self.ranges:
+            conditions.append("("+" OR ".join(["epoch >= ? AND epoch < ?"] * len(ranges))+")")
+            for start, end in ranges:
+                values += [start, end]
+        if len(conditions) == 0:
+            return "", []
+        return " WHERE "+" AND ".join(conditions), values
 
 
 def process_transactions(config, html):
@@ -585,211 +3476,162 @@ def process_transactions(config, html):
 
     if not config["silentMode"]:
         print("Processing Transactions...")
-    soup = BeautifulSoup(html, "lxml")
+
+    # When the page and settings are the ones processed last time, only
+    # prices can have changed (new or repaired minutes, a day or month that
+    # was still open): the ledger is re-priced without parsing the page
+    snapshot = None
+    unchanged = False
+    if config["snapshots"] and "replay" not in config:
+        with span("snapshot", config):
+            snapshot = save_snapshot(config, html)
+        unchanged = config["useLedger"] and snapshot_key(config, snapshot) == processed_snapshot(config)
+
+    process_span = span("process", config)
+    process_span.start()
+
+    use_currency(config)
+    ledger = open_ledger(config)
+    if "watchCycle" in config:
+        ledgers[config["ledgerFile"]] = ledger
+    changes = ledger.total_changes
+    transaction_filter = TransactionFilter(config)
+    with span("parse", config) as counts:
+        records = parse_transactions(html, config["parser"]) if not unchanged else []
+        # Without a ledger to keep (or to reuse in --watch), rows that can't
+        # be selected are not converted or priced at all
+        record_filter = None
+        if not config["useLedger"] and "watchCycle" not in config and transaction_filter.active():
+            record_filter = transaction_filter
+        if profiler is not None and profiler.parse_profile is not None:
+            newTransactions = profiler.parse_profile.runcall(
+                ingest_transactions, config, ledger, records, record_filter)
+        else:
+            newTransactions = ingest_transactions(config, ledger, records, record_filter)
+        counts["rows"] = newTransactions
+    if unchanged and ledger.total_changes == changes:
+        if not config["silentMode"]:
+            print("Transactions unchanged (snapshot "+snapshot[0:16]+").")
+        if config["ledgerFile"] not in ledgers:
+            ledger.close()
+        process_span.stop()
+        return
+    if config["useLedger"] and not config["silentMode"]:
+        print("New Transactions:", newTransactions)
+
+    # --watch: outputs are only rewritten when the ledger changed
+    if config.get("watchCycle", 0) > 1 and ledger.total_changes == changes:
+        if not config["silentMode"]:
+            print("No changes.")
+        if snapshot is not None:
+            mark_snapshot(config, snapshot)
+        process_span.stop()
+        return
 
     transactions = []
     totalTransactions = 0
     selectedTransactions = 0
+    unpricedTransactions = 0
     totalBTCdeposited = 0.0
     totalBTCwithdrawn = 0.0
     totalBTCmined = 0.0
     totalBTCminedUSD = 0.0
     minersBTCmined = {}
 
-    if config["populategooglesheet"]:
-        row = 1  # starting row in the google sheet
-        cells = []
-        # mark the time in the google sheet
-        cells.append(Cell(row=row, col=1, value=config["datetime"]))
-        row += 1
-
-    for link in soup.find_all("a")[::-1]:
-        res = sub('(\t| )+', ' ', link.text)
-        res = sub('\n+', '\n', res)
-        res = sub(' 0.', "0.", res)
-
-        res = res.strip()
-        res = res.splitlines()
-
-        if len(res) == 3:
-            date = res[1].split(" ")
-            if len(date) == 5:
-
-                totalTransactions += 1
-                transaction_id = totalTransactions
-
-                # Line 1
-                miner_id = 0
-                line1 = res[0].split(" ")
-                transaction_type = line1[0]
-                if len(line1) == 3:
-                    miner_id = int(line1[2][0:-1])
-                
-                def multi_filer_equal(config, item, compare, full=False):
-                    if item in config:
-                        cont = True
-                        for each in config[item].split(','):
-                            if full:
-                                if each == compare:
-                                    cont = False
-                                    break
-                            else:
-                                if each == compare[:len(each)]:
-                                    cont = False
-                                    break
-                        return cont
-                    return False
-                
-                def multi_filer_not_equal(config, item, compare, full=False):
-                    if item in config:
-                        return not multi_filer_equal(config, item, compare, full)
-                    return False
-                
-                # Miner exclusion code
-                if multi_filer_equal(config, "miner", str(miner_id), True):
-                    continue
-
-                # Line 2
-                if not tzsetDisabledInternal:
-                    environ['TZ'] = default_timezone
-                    tzset()
-                ttime = strptime(res[1], "%b %d, %Y %I:%M %p")
+    # Rows are streamed to the exports newest first; only a Google Sheet
+    # sync keeps them in memory
+    exports = open_exports(config) if config["saveCSV"] else []
 
-                transaction_epoch = int(mktime(ttime))
-
-                # Optionally output Date/Time in alternate timezone
-                date_time_fmt = "%Y-%m-%d %H:%M"
-
-                if not tzsetDisabledInternal:
-                    environ['TZ'] = config["timezone"]
-                    tzset()
-                    date_time_fmt = "%Y-%m-%d %H:%M %Z%z"
-
-                transaction_time = strftime(
-                    date_time_fmt, localtime(transaction_epoch))
-
-                if tzsetDisabledInternal and not pytzDisabledInternal:
-                    transaction_time, transaction_epoch = convert_timezones(
-                        transaction_time+":00", default_timezone, config["timezone"])
-
-                # Transaction exclusion code
-                if "year" in config and transaction_time[0:4] != config["year"]:
-                    continue
-                
-                if multi_filer_equal(config, "select", transaction_time):
-                    continue
-                
-                if "exclude" in config and transaction_time[0:len(config["exclude"])] == config["exclude"]:
-                    continue
-                
-                selectedTransactions += 1
-
-                # Line 3
-                line3 = res[2].split(" ")
-                transaction_amount = line3[0]
-                transaction_amount_type = line3[1]
-
-                fmv_cur = 0.0
-                if str(transaction_epoch) in bitcoin:
-                    btc = bitcoin[str(transaction_epoch)]
-                    #fmv_cur = (float(btc_USD[3])+float(btc_USD[4]))/2.0
-                    fmv_cur = float(btc[2])
-
-                transaction_amount_cur = float(transaction_amount) * fmv_cur
-
-                if transaction_type == "Withdraw":
-                    totalBTCwithdrawn += float(transaction_amount)
-                elif len(line1) == 3:  # Miner Deposit
-                    totalBTCmined += float(transaction_amount)
-                    totalBTCminedUSD += float(transaction_amount) * fmv_cur
-                    try:
-                        minersBTCmined[miner_id] += float(transaction_amount)
-                    except:
-                        minersBTCmined[miner_id] = float(transaction_amount)
-                elif len(line1) == 2:  # BTC deposit
-                    totalBTCdeposited += float(transaction_amount)
-
-                transaction = []
-                transaction.append(transaction_epoch)
-                transaction.append(transaction_id)
-                transaction.append(transaction_time)
-                transaction.append(transaction_type)
-                transaction.append(miner_id)
-                transaction.append(transaction_amount)
-                transaction.append(transaction_amount_type)
-                if bitcoin_loaded:
-                    transaction.append(
-                        bitcoin_currancy+str(transaction_amount_cur))
-                    transaction.append(bitcoin_currancy+str(fmv_cur))
-
-                transactions.insert(0, transaction)
-
-    if config["populategooglesheet"] and totalTransactions > 0:
-        cells.append(Cell(row=row, col=1, value="Miner ID"))
-        cells.append(Cell(row=row, col=2, value="Epoch"))
-        cells.append(Cell(row=row, col=3, value="Transaction"))
-        cells.append(Cell(row=row, col=4, value="Amount"))
-        cells.append(Cell(row=row, col=5, value="Date"))
-        cells.append(Cell(row=row, col=6, value="Type"))
-        cells.append(Cell(row=row, col=7, value="Currency"))
-        if bitcoin_loaded:
-            cells.append(Cell(row=row, col=8, value="FMV"))
-            cells.append(Cell(row=row, col=9, value="Bitcoin"))
-
-        row += 1
-        for transaction in transactions:
-            cells.append(Cell(row=row, col=1, value=transaction[4]))
-            cells.append(Cell(row=row, col=2, value=transaction[0]))
-            cells.append(Cell(row=row, col=3, value=transaction[1]))
-            cells.append(Cell(row=row, col=4, value=transaction[5]))
-            cells.append(Cell(row=row, col=5, value=transaction[2]))
-            cells.append(Cell(row=row, col=6, value=transaction[3]))
-            cells.append(Cell(row=row, col=7, value=transaction[6]))
+    select_span = span("select", config)
+    select_span.start()
+    totalTransactions = ledger.execute("SELECT COUNT(*) FROM transactions").fetchone()[0] + transaction_filter.skipped
+    where, values = transaction_filter.where()
+    try:
+        for transaction_id, transaction_epoch, transaction_time, transaction_type, miner_id, transaction_amount, \
+                transaction_amount_type, kind, fmv in ledger.execute(
+                    "SELECT transaction_id, epoch, time, type, miner, amount, currency, kind, fmv FROM transactions"+where+" ORDER BY transaction_id DESC",
+                    values):
+
+            # Miner, kind and date selection
+            if not transaction_filter.match(miner_id, kind, transaction_time):
+                continue
+
+            selectedTransactions += 1
+
+            fmv_cur = 0.0
+            if fmv is not None:
+                fmv_cur = fmv
+            elif bitcoin_loaded:
+                unpricedTransactions += 1
+
+            transaction_amount_cur = float(transaction_amount) * fmv_cur
+
+            if kind == "withdraw":
+                totalBTCwithdrawn += float(transaction_amount)
+            elif kind == "mined":
+                totalBTCmined += float(transaction_amount)
+                totalBTCminedUSD += float(transaction_amount) * fmv_cur
+                minersBTCmined[miner_id] = minersBTCmined.get(miner_id, 0.0) + float(transaction_amount)
+            elif kind == "deposit":
+                totalBTCdeposited += float(transaction_amount)
+
+            transaction = []
+            transaction.append(transaction_epoch)
+            transaction.append(transaction_id)
+            transaction.append(transaction_time)
+            transaction.append(transaction_type)
+            transaction.append(miner_id)
+            transaction.append(transaction_amount)
+            transaction.append(transaction_amount_type)
             if bitcoin_loaded:
-                cells.append(Cell(row=row, col=8, value=transaction[7]))
-                cells.append(Cell(row=row, col=9, value=transaction[8]))
-            row += 1
+                transaction.append(
+                    bitcoin_currancy+str(transaction_amount_cur))
+                transaction.append(bitcoin_currancy+str(fmv_cur))
+
+            for export in exports:
+                export.write(transaction)
+            if config["populategooglesheet"]:
+                transactions.append(transaction)
+    except BaseException:
+        for export in exports:
+            export.discard()
+        raise
+
+    select_span.counts.update(rows=totalTransactions, selected=selectedTransactions)
+    if bitcoin_loaded:
+        select_span.counts["unpriced"] = unpricedTransactions
+    select_span.stop()
+
+    if config["gainsReport"]:
+        print_gains(config, ledger)
+    if config["ledgerFile"] not in ledgers:
+        ledger.close()
+
+    with span("export", config) as counts:
+        for export in exports:
+            if selectedTransactions > 0:
+                if not config["silentMode"]:
+                    print("Saving '"+export.file_name+"'")
+                export.close()
+            else:
+                export.discard()
+        counts["rows"] = selectedTransactions
 
     if totalTransactions > 0 and selectedTransactions > 0:
-        if config["saveCSV"]:
-            if not config["silentMode"]:
-                print("Saving '"+config["csvFile"]+"'")
-
-            with open(config["csvFile"], 'w') as f:
-                if bitcoin_loaded:
-                    f.write(
-                        "Epoch, Transaction, Date, Type, Miner ID, Amount, Currency, FMV, Bitcoin\n")
-                else:
-                    f.write(
-                        "Epoch, Transaction, Date, Type, Miner ID, Amount, Currency\n")
-
-                for transaction in transactions:
-                    f.write(sub("'", '', str(transaction)[1:-1])+"\n")
 
         if config["populategooglesheet"]:
             if not config["silentMode"]:
                 print("Populating Google Sheet")
-
-            # google sheets scope setup
-            scope = ['https://spreadsheets.google.com/feeds', 'https://www.googleapis.com/auth/spreadsheets',
-                     'https://www.googleapis.com/auth/drive.file', 'https://www.googleapis.com/auth/drive']
-
-            if not exists(config["googleCreds"]):
-                assert False, "Google service account credentials file not found (" + \
-                    config["googleCreds"]+")"
-            creds = service_account.Credentials.from_service_account_file(
-                config["googleCreds"], scopes=scope)
-            client = authorize(creds)
-            sheet = client.open(config["googleSheet"])  # the spreadhseet name
-            # the worksheet name (in the spreadsheet above)
-            wksheet = sheet.worksheet(config["googleWorksheet"])
-            wksheet.update_cells(cells, value_input_option='USER_ENTERED')
+            with span("google_sheet", config) as counts:
+                counts["cells"] = sync_google_sheet(config, transactions)
 
         if not config["silentMode"]:
             print("")
             print("Total Transactions    =", totalTransactions)
             if totalTransactions != selectedTransactions:
                 print("Selected Transactions =", selectedTransactions)
+            if bitcoin_loaded and unpricedTransactions > 0:
+                print("Unpriced Transactions =", unpricedTransactions, "(see ./cac.py -gaps)")
             print("")
             print(f"Total BTC Deposited   = {totalBTCdeposited:.8f}")
             print(f"Total BTC Withdrawn   = {totalBTCwithdrawn:.8f}")
@@ -806,6 +3648,10 @@ def process_transactions(config, html):
     elif not config["silentMode"]:
         print("No Transactions!\n")
 
+    if snapshot is not None:
+        mark_snapshot(config, snapshot)
+    process_span.stop()
+
 
 if __name__ == "__main__":
     main()